@@ -0,0 +1,193 @@
+"""
+病棟一覧などの看護情報をまとめて処理するヘッドレスのバッチ生成。
+
+    python batch.py notes.csv -o plans.jsonl --concurrency 8
+
+入力: CSV（列 id, patient_text, output_format）または JSONL（同じキー）。
+      output_format 省略時は --format の値を使用。id 省略時は行番号。
+出力: 1件ごとに JSONL へ追記（{"id", "output_format", "result"} または {"id", "error"}）。
+      出力ファイル自体がチェックポイントを兼ね、再実行時は result 済みの id をスキップします。
+"""
+import os
+import csv
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from openai import (
+    OpenAI, AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+)
+from dotenv import load_dotenv
+from prompts import build_generation_prompt
+from inference import TEMPERATURE, response_format_for, complete_plan
+from utils import json_loads_safe
+from routing import route
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+FORMATS = ("SOAP形式", "看護計画表形式", "両方")
+
+logger = logging.getLogger(__name__)
+
+def iter_records(path: str, default_format: str):
+    """入力ファイルを1件ずつ読み出す（全件をメモリに載せない）"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = _iter_jsonl(f)
+        for i, row in enumerate(rows, start=1):
+            text = (row.get("patient_text") or "").strip()
+            if not text:
+                continue
+            fmt = row.get("output_format") or default_format
+            yield {
+                "id": str(row.get("id") or i),
+                "patient_text": text,
+                "output_format": fmt if fmt in FORMATS else default_format,
+            }
+
+def _iter_jsonl(f):
+    # 壊れた行は記録して読み飛ばす（1行のために全体を止めない）。行番号を保つため None を返す
+    for lineno, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            logger.warning("skipping invalid JSONL line %d: %s", lineno, e)
+            row = None
+        if not isinstance(row, dict):
+            if row is not None:
+                logger.warning("skipping JSONL line %d: not an object", lineno)
+            row = {}
+        yield row
+
+def load_done_ids(path: str) -> set:
+    """既存の出力から処理済み id を集める（途中で壊れた最終行は無視）"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "result" in rec:
+                done.add(rec["id"])
+    return done
+
+def _terminate_last_line(path: str):
+    """途中で中断して改行で終わっていない出力なら改行を足す（追記する最初の1件が壊れた行に連結されないように）"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+def _retry_after(e: Exception):
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+async def generate_one(client: AsyncOpenAI, record: dict, max_retries: int, base_delay: float,
+                       section_client: OpenAI) -> dict:
+    messages = build_generation_prompt(record["patient_text"], record["output_format"])
+    model = route("generation", record["patient_text"]).model
+    for attempt in range(max_retries + 1):
+        try:
+            resp = await client.chat.completions.create(
+                model=model,
+                temperature=TEMPERATURE,
+                messages=messages,
+                response_format=response_format_for()
+            )
+            # 検証に失敗したセクションだけを UI と同じ処理で再要求する（全体の再生成はしない）
+            data = await asyncio.to_thread(
+                complete_plan, section_client, record["patient_text"], record["output_format"],
+                json_loads_safe(resp.choices[0].message.content or ""), model
+            )
+            if data is None:
+                return {"id": record["id"], "error": "ValueError: 出力の解析に失敗しました"}
+            return {"id": record["id"], "output_format": record["output_format"], "result": data}
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                return {"id": record["id"], "error": f"{type(e).__name__}: {e}"}
+            # Retry-After を優先し、なければ指数バックオフ＋ジッター
+            delay = _retry_after(e) or base_delay * (2 ** attempt)
+            await asyncio.sleep(delay * (0.5 + random.random()))
+        except Exception as e:
+            return {"id": record["id"], "error": f"{type(e).__name__}: {e}"}
+
+async def run_batch(input_path: str, output_path: str, concurrency: int = 8, default_format: str = "両方",
+                    max_retries: int = 5, base_delay: float = 1.0, client: AsyncOpenAI = None) -> dict:
+    client = client or AsyncOpenAI(max_retries=0)
+    # セクション単位の再要求は inference と共通の同期処理のため、同じ接続先の同期クライアントを使う
+    section_client = OpenAI(api_key=client.api_key, base_url=client.base_url, max_retries=max_retries)
+    done = load_done_ids(output_path)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"skipped": 0, "ok": 0, "error": 0}
+    started = time.perf_counter()
+
+    _terminate_last_line(output_path)
+    with open(output_path, "a", encoding="utf-8") as out:
+        async def worker():
+            while True:
+                record = await queue.get()
+                if record is None:
+                    return
+                rec = await generate_one(client, record, max_retries, base_delay, section_client)
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                out.flush()
+                stats["error" if "error" in rec else "ok"] += 1
+
+        async def producer():
+            for record in iter_records(input_path, default_format):
+                if record["id"] in done:
+                    stats["skipped"] += 1
+                    continue
+                await queue.put(record)
+            for _ in workers:
+                await queue.put(None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        tasks = [asyncio.create_task(producer()), *workers]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # どれかが失敗したら（出力の書き込みエラーなど）残りを止める（queue.put で待ち続けない）
+            for task in tasks:
+                task.cancel()
+
+    stats["elapsed_sec"] = round(time.perf_counter() - started, 2)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="看護計画のバッチ生成")
+    parser.add_argument("input", help="入力ファイル（.csv / .jsonl）")
+    parser.add_argument("-o", "--output", required=True, help="出力 JSONL（チェックポイント兼用）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時リクエスト数")
+    parser.add_argument("--format", default="両方", choices=FORMATS, help="output_format 未指定時の既定値")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--base-delay", type=float, default=1.0, help="バックオフの初期待ち秒数")
+    args = parser.parse_args()
+
+    load_dotenv(override=False)
+    stats = asyncio.run(run_batch(
+        args.input, args.output, concurrency=args.concurrency, default_format=args.format,
+        max_retries=args.max_retries, base_delay=args.base_delay
+    ))
+    print(json.dumps(stats, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
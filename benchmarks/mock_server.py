@@ -0,0 +1,183 @@
+"""
+Chat Completions エンドポイントのローカル代替（ベンチマーク・オフライン検証用）。
+
+    python -m benchmarks.mock_server --port 8765 --latency-ms 300 --tokens-per-sec 80 --malformed-rate 0.05
+
+OpenAI クライアントは base_url="http://127.0.0.1:8765/v1" で接続します。
+- response_format が json_schema / json_object のときは看護計画JSONを合成（スキーマのセクションのみ）
+- それ以外はフォローアップ回答風のテキスト
+- stream=True では SSE で断片を返し、stream_options.include_usage なら最後に usage を返す
+- 差分更新の依頼（前回の計画を含むプロンプト）には、大半を "#番号" 参照にした計画を返す
+- malformed_rate の確率で壊れたJSON（末尾カンマ・コードフェンス・途中切れ）を返す
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PLAN_TEMPLATE = {
+    "soap": {
+        "assessment": "疼痛および活動制限に関連した転倒リスクの上昇（所見{i}）",
+        "plan": "離床前にバイタルと疼痛を評価し、2時間ごとに体位変換を実施（計画{i}）",
+    },
+    "plan_table": {
+        "problems": "急性疼痛（NANDA-I）関連因子: 手術侵襲（{i}）",
+        "assessments": "NRS・表情・体動時の疼痛増強を毎勤務帯で観察（{i}）",
+        "goals": "NOC: 疼痛レベル — 48時間以内にNRS3以下（{i}）",
+        "interventions": "NIC: 疼痛管理 — 鎮痛薬の定時投与と効果判定を30分後に実施（{i}）",
+        "evaluation": "NRS推移と離床距離で再評価し、未達時は医師と鎮痛計画を見直す（{i}）",
+    },
+    "reasoning_summary": {
+        "key_findings": "術後疼痛とふらつきの併存（{i}）",
+        "rationales": "疼痛コントロールが離床と転倒予防の前提となるため（{i}）",
+        "differentials": "せん妄・起立性低血圧の関与も考慮（{i}）",
+    },
+}
+
+ANSWER_TEMPLATE = "- 目標は患者の疼痛スコアと離床状況を根拠に設定しています。\n- 介入は頻度とタイミングを明示し、評価につなげています。\n"
+
+class MockConfig:
+    def __init__(self, latency_ms: float = 200, tokens_per_sec: float = 0, malformed_rate: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms          # 最初の応答までの待ち（TTFT 相当）
+        self.tokens_per_sec = tokens_per_sec  # 0 なら出力待ちなし
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def roll_malformed(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            return self.random.random() < self.malformed_rate
+
+def _requested_sections(body: dict):
+    fmt = body.get("response_format") or {}
+    if fmt.get("type") == "json_schema":
+        return list(fmt["json_schema"]["schema"]["properties"])
+    if fmt.get("type") == "json_object":
+        return list(PLAN_TEMPLATE)
+    return None
+
+def build_content(body: dict, malformed: bool, rng=random) -> str:
+    sections = _requested_sections(body)
+    user = (body.get("messages") or [{}])[-1].get("content") or ""
+    if sections is None:
+        return ANSWER_TEMPLATE * max(1, len(user) // 400)
+    if "前回の計画" in user:
+        # 差分更新: 前回の項目は参照で返し、各キー1件だけ書き直す
+        plan = {
+            sec: {key: ["#1", "#2", tmpl.format(i="更新")] for key, tmpl in PLAN_TEMPLATE[sec].items()}
+            for sec in sections
+        }
+    else:
+        # 入力が長いほど項目数を増やす（3〜5件）
+        n = min(5, 3 + len(user) // 400)
+        plan = {
+            sec: {key: [tmpl.format(i=i + 1) for i in range(n)] for key, tmpl in PLAN_TEMPLATE[sec].items()}
+            for sec in sections
+        }
+    text = json.dumps(plan, ensure_ascii=False, indent=1)
+    if malformed:
+        kind = rng.choice(["comma", "fence", "truncate"])
+        if kind == "comma":
+            text = text.replace("]", ",]", 1)
+        elif kind == "fence":
+            text = "```json\n" + text + "\n```"
+        else:
+            text = text[: len(text) * 2 // 3]
+    return text
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+def make_handler(config: MockConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            content = build_content(body, config.roll_malformed(), config.random)
+            prompt_tokens = sum(_estimate_tokens(m.get("content") or "") for m in body.get("messages", []))
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": _estimate_tokens(content),
+                "total_tokens": prompt_tokens + _estimate_tokens(content),
+                "prompt_tokens_details": {"cached_tokens": 0},
+            }
+            time.sleep(config.latency_ms / 1000)
+            if body.get("stream"):
+                self._stream(body, content, usage)
+            else:
+                self._complete(body, content, usage)
+
+        def _complete(self, body: dict, content: str, usage: dict):
+            if config.tokens_per_sec:
+                time.sleep(usage["completion_tokens"] / config.tokens_per_sec)
+            payload = json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            }, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _stream(self, body: dict, content: str, usage: dict):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": body.get("model", "mock")}
+            step = 4   # 約2トークン/断片
+            for i in range(0, len(content), step):
+                piece = content[i:i + step]
+                self._event({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                if config.tokens_per_sec:
+                    time.sleep(_estimate_tokens(piece) / config.tokens_per_sec)
+            self._event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._event({**base, "choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+        def _event(self, data: dict):
+            self.wfile.write(b"data: " + json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+    return Handler
+
+def start_server(config: MockConfig, host: str = "127.0.0.1", port: int = 0):
+    """バックグラウンドスレッドで起動し、(server, base_url) を返す"""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat Completions のモックサーバ")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--tokens-per-sec", type=float, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    config = MockConfig(args.latency_ms, args.tokens_per_sec, args.malformed_rate, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(config))
+    print(f"mock server: http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
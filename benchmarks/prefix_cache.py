@@ -0,0 +1,105 @@
+"""
+プロンプト配置（静的プレフィックス先頭 vs 旧レイアウト）によるキャッシュ率・コスト・レイテンシ比較。
+実APIを呼ぶため OPENAI_API_KEY が必要です。
+
+    python -m benchmarks.prefix_cache --rounds 2
+
+同じコーパスを rounds 回流し、各レイアウトの prompt/cached/completion トークン、
+推定コスト、平均/ p95 レイテンシを JSON で出力します。
+※ OpenAI のプロンプトキャッシュは 1024 トークン以上の共通プレフィックスが対象です。静的プレフィックスの
+  見積もりトークン数（static_prefix_tokens）も出力します。これが 1024 未満ならどちらのレイアウトでも
+  cached_tokens は 0 になり、差はレイテンシの揺らぎのみです。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from openai import OpenAI
+from prompts import SYSTEM_ROLE, PLAN_JSON_SPEC, GENERATION_SYSTEM, build_generation_prompt, estimate_tokens
+from inference import MODEL, TEMPERATURE, response_format_for
+from routing import cost_usd
+
+CORPUS = os.path.join(os.path.dirname(__file__), "corpus.jsonl")
+CACHE_MIN_PREFIX_TOKENS = 1024
+
+def build_legacy_prompt(patient_text: str, output_format: str) -> list:
+    # 変更前のレイアウト: 看護情報がユーザーメッセージの先頭、仕様ブロックが末尾
+    user = f"""看護情報:
+\"\"\"{patient_text}\"\"\"
+
+要求:
+- 出力形式の希望: {output_format}
+- SOAP形式では A（Assessment）と P（Plan）を列挙
+- 看護計画表形式では 問題/アセスメント/目標(NOC)/介入(NIC)/評価 を列挙
+- NANDA-I/NIC/NOC に準拠（用語/視点）
+- 重複や冗長表現を避ける
+- 実行可能性・安全性を明示（頻度、条件、観察ポイントなど）
+
+{PLAN_JSON_SPEC}
+"""
+    return [
+        {"role":"system", "content": SYSTEM_ROLE},
+        {"role":"user", "content": user}
+    ]
+
+LAYOUTS = {"legacy": build_legacy_prompt, "prefix": build_generation_prompt}
+
+def load_corpus(path: str = CORPUS) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def run_layout(client: OpenAI, build, corpus: list, rounds: int) -> dict:
+    latencies, prompt, cached, completion = [], 0, 0, 0
+    for _ in range(rounds):
+        for rec in corpus:
+            started = time.perf_counter()
+            resp = client.chat.completions.create(
+                model=MODEL,
+                temperature=TEMPERATURE,
+                messages=build(rec["patient_text"], rec["output_format"]),
+                response_format=response_format_for()
+            )
+            latencies.append(time.perf_counter() - started)
+            usage = resp.usage
+            details = getattr(usage, "prompt_tokens_details", None)
+            prompt += usage.prompt_tokens
+            cached += getattr(details, "cached_tokens", None) or 0
+            completion += usage.completion_tokens
+    return {
+        "requests": len(latencies),
+        "prompt_tokens": prompt,
+        "cached_tokens": cached,
+        "cached_ratio": round(cached / prompt, 3) if prompt else 0.0,
+        "completion_tokens": completion,
+        "cost_usd": round(cost_usd(MODEL, prompt, cached, completion), 6),
+        "latency_mean_sec": round(statistics.mean(latencies), 3),
+        "latency_p95_sec": round(sorted(latencies)[int(0.95 * (len(latencies) - 1))], 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="プロンプトプレフィックス配置のベンチマーク")
+    parser.add_argument("--rounds", type=int, default=2, help="コーパスを流す回数（2回目以降がキャッシュ対象）")
+    parser.add_argument("--corpus", default=CORPUS)
+    args = parser.parse_args()
+
+    load_dotenv(override=False)
+    client = OpenAI()
+    corpus = load_corpus(args.corpus)
+    # 構造化出力のスキーマもプレフィックスに含まれる
+    prefix_tokens = estimate_tokens(GENERATION_SYSTEM) + estimate_tokens(json.dumps(response_format_for(), ensure_ascii=False))
+    results = {
+        "model": MODEL,
+        "static_prefix_tokens": prefix_tokens,
+        "prefix_cache_eligible": prefix_tokens >= CACHE_MIN_PREFIX_TOKENS,
+    }
+    results.update({name: run_layout(client, build, corpus, args.rounds) for name, build in LAYOUTS.items()})
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
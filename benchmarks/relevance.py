@@ -0,0 +1,115 @@
+"""
+フォローアップ質問の関連性判定のベンチマーク（APIキー不要）。
+
+    python -m benchmarks.relevance
+
+ラベル付き質問で旧来のキーワード走査と relevance.classify を比較し、precision / recall・
+不要な answer_followup 呼び出し（誤通過）と回避できた件数・1件あたりの判定時間を出力します。
+  relevance_labels.jsonl   語彙と一緒に作ったラベル（語彙の抜け漏れ確認用。ここでの精度は楽観的）
+  relevance_tuning.jsonl   語彙の調整に使った質問（当初の確認用セットと誤通過の報告例。ここでの精度も楽観的）
+  relevance_heldout.jsonl  調整に使わない質問（結果を見て語彙・しきい値を変えたら tuning 側へ移し、新しく書き直す）
+コンテキストはモックサーバと同じテンプレートで合成した last_outputs を使います。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_server import PLAN_TEMPLATE
+from benchmarks.run import load_corpus
+from metrics import percentile
+import relevance
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LABELS = os.path.join(HERE, "relevance_labels.jsonl")
+TUNING = os.path.join(HERE, "relevance_tuning.jsonl")
+HELDOUT = os.path.join(HERE, "relevance_heldout.jsonl")
+# 置き換え前の utils.RELEVANT_KEYWORDS（比較用）
+LEGACY_KEYWORDS = [
+    "看護", "患者", "診断", "目標", "介入", "評価", "アセスメント", "SOAP", "計画", "根拠", "要点",
+    "NANDA", "NANDA-I", "NIC", "NOC"
+]
+
+def legacy_is_relevant(q: str, last_outputs: dict = None) -> bool:
+    q = q.strip()
+    if not q: return False
+    return any(k.lower() in q.lower() for k in LEGACY_KEYWORDS)
+
+def sample_last_outputs(patient_text: str) -> dict:
+    plan = {
+        sec: {key: [tmpl.format(i=i + 1) for i in range(3)] for key, tmpl in fields.items()}
+        for sec, fields in PLAN_TEMPLATE.items()
+    }
+    return {"patient_text": patient_text, "output_format": "両方", **plan}
+
+def evaluate(fn, labels: list, last_outputs: dict, repeats: int) -> dict:
+    tp = fp = fn_ = tn = 0
+    misses = []
+    for row in labels:
+        pred = fn(row["question"], last_outputs)
+        if pred and row["relevant"]: tp += 1
+        elif pred: fp += 1
+        elif row["relevant"]: fn_ += 1
+        else: tn += 1
+        if pred != row["relevant"]:
+            misses.append(row["question"])
+    latencies = []
+    for _ in range(repeats):
+        for row in labels:
+            t0 = time.perf_counter()
+            fn(row["question"], last_outputs)
+            latencies.append((time.perf_counter() - t0) * 1e6)
+    return {
+        "precision": round(tp / (tp + fp), 3) if tp + fp else None,
+        "recall": round(tp / (tp + fn_), 3) if tp + fn_ else None,
+        "api_calls": tp + fp,            # 判定を通過し answer_followup を呼ぶ件数
+        "wasted_calls": fp,              # 無関係なのに呼んでしまう件数
+        "blocked_relevant": fn_,         # 関連があるのにモデルに届かない件数
+        "p50_us": round(percentile(latencies, 0.5), 1),
+        "p95_us": round(percentile(latencies, 0.95), 1),
+        "misclassified": misses,
+    }
+
+def load_labels(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(labels: list, last_outputs: dict, repeats: int) -> dict:
+    legacy = evaluate(legacy_is_relevant, labels, last_outputs, repeats)
+    gate = evaluate(relevance.is_relevant, labels, last_outputs, repeats)
+    return {
+        "labels": len(labels),
+        "positives": sum(1 for r in labels if r["relevant"]),
+        "legacy_keyword_scan": legacy,
+        "relevance_gate": gate,
+        "wasted_calls_avoided": legacy["wasted_calls"] - gate["wasted_calls"],
+        "relevant_recovered": legacy["blocked_relevant"] - gate["blocked_relevant"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="関連性判定の精度・速度の比較")
+    parser.add_argument("--labels", default=LABELS)
+    parser.add_argument("--tuning", default=TUNING)
+    parser.add_argument("--heldout", default=HELDOUT)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    last_outputs = sample_last_outputs(load_corpus()[0]["patient_text"])
+
+    t0 = time.perf_counter()
+    relevance.classify("初回", last_outputs)   # コンテキストのベクトル化（生成ごとに1回）
+    context_ms = (time.perf_counter() - t0) * 1000
+
+    report = {
+        "context_embed_ms": round(context_ms, 2),
+        "labels": compare(load_labels(args.labels), last_outputs, args.repeats),
+        "tuning": compare(load_labels(args.tuning), last_outputs, args.repeats),
+        "heldout": compare(load_labels(args.heldout), last_outputs, args.repeats),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
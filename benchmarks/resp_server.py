@@ -0,0 +1,158 @@
+"""
+Redis プロトコル（RESP2）のローカル代替（state_backend.RedisStateBackend のオフライン検証用）。
+
+    python -m benchmarks.resp_server --port 6390
+
+CAREPLAN_STATE_BACKEND=redis CAREPLAN_REDIS_URL=redis://127.0.0.1:6390/0 で接続します。
+対応コマンド: PING / AUTH / SELECT / GET / SET（EX）/ DEL / EXPIRE / TTL / RPUSH / LRANGE / LLEN / FLUSHDB
+（データはメモリ上のみ。有効期限は参照時に判定）
+"""
+import time
+import argparse
+import threading
+import socketserver
+
+class _Store:
+    def __init__(self):
+        self.data = {}      # key -> bytes | list[bytes]
+        self.expires = {}   # key -> monotonic 期限
+        self.lock = threading.Lock()
+
+    def alive(self, key) -> bool:
+        exp = self.expires.get(key)
+        if exp is not None and exp <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                args = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            self.wfile.write(self._dispatch(args))
+            self.wfile.flush()
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()   # インラインコマンド（redis-cli / telnet 用）
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def _dispatch(self, args) -> bytes:
+        store = self.server.store
+        cmd = args[0].upper().decode()
+        with store.lock:
+            try:
+                return getattr(self, f"_cmd_{cmd.lower()}")(store, args[1:])
+            except AttributeError:
+                return f"-ERR unknown command '{cmd}'\r\n".encode()
+            except (IndexError, ValueError):
+                return f"-ERR wrong arguments for '{cmd}'\r\n".encode()
+
+    # ===== commands =====
+    def _cmd_ping(self, store, args):
+        return b"+PONG\r\n"
+
+    def _cmd_auth(self, store, args):
+        return b"+OK\r\n"
+
+    def _cmd_select(self, store, args):
+        return b"+OK\r\n"
+
+    def _cmd_flushdb(self, store, args):
+        store.data.clear()
+        store.expires.clear()
+        return b"+OK\r\n"
+
+    def _cmd_get(self, store, args):
+        if not store.alive(args[0]):
+            return b"$-1\r\n"
+        value = store.data[args[0]]
+        if isinstance(value, list):
+            return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+        return _bulk(value)
+
+    def _cmd_set(self, store, args):
+        key, value = args[0], args[1]
+        store.data[key] = value
+        store.expires.pop(key, None)
+        opts = [a.upper() for a in args[2:]]
+        if b"EX" in opts:
+            store.expires[key] = time.monotonic() + int(args[2 + opts.index(b"EX") + 1])
+        return b"+OK\r\n"
+
+    def _cmd_del(self, store, args):
+        n = 0
+        for key in args:
+            if store.alive(key):
+                del store.data[key]
+                store.expires.pop(key, None)
+                n += 1
+        return b":%d\r\n" % n
+
+    def _cmd_expire(self, store, args):
+        if not store.alive(args[0]):
+            return b":0\r\n"
+        store.expires[args[0]] = time.monotonic() + int(args[1])
+        return b":1\r\n"
+
+    def _cmd_ttl(self, store, args):
+        if not store.alive(args[0]):
+            return b":-2\r\n"
+        exp = store.expires.get(args[0])
+        return b":-1\r\n" if exp is None else b":%d\r\n" % int(exp - time.monotonic())
+
+    def _cmd_rpush(self, store, args):
+        if not store.alive(args[0]):
+            store.data[args[0]] = []
+        store.data[args[0]].extend(args[1:])
+        return b":%d\r\n" % len(store.data[args[0]])
+
+    def _cmd_llen(self, store, args):
+        return b":%d\r\n" % (len(store.data[args[0]]) if store.alive(args[0]) else 0)
+
+    def _cmd_lrange(self, store, args):
+        items = store.data[args[0]] if store.alive(args[0]) else []
+        start, stop = int(args[1]), int(args[2])
+        stop = len(items) if stop == -1 else stop + 1
+        selected = items[start:stop]
+        return b"*%d\r\n" % len(selected) + b"".join(_bulk(x) for x in selected)
+
+def _bulk(value: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _Handler)
+        self.store = _Store()
+
+def start_server(host: str = "127.0.0.1", port: int = 0):
+    """バックグラウンドスレッドで起動し、(server, url) を返す"""
+    server = RespServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"redis://{host}:{server.server_address[1]}/0"
+
+def main():
+    parser = argparse.ArgumentParser(description="Redis プロトコルのローカル代替")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    server = RespServer(("127.0.0.1", args.port))
+    print(f"resp server: redis://127.0.0.1:{args.port}/0")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
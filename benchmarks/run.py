@@ -0,0 +1,208 @@
+"""
+APIキー不要のオフラインベンチマーク。ローカルのモックサーバ（benchmarks/mock_server.py）に対して
+generate_care_plan（全体・差分更新）/ answer_followup / json_loads_safe / components.history_timeline を計測します。
+
+    python -m benchmarks.run                     # 計測して baseline.json と比較
+    python -m benchmarks.run --save-baseline     # 現在の結果を基準値として保存
+    python -m benchmarks.run --fail-on-regression --tolerance 0.2
+
+各シナリオの件数・エラー数・スループット・p50/p95 レイテンシ・ピークメモリ（tracemalloc）を出力します。
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 応答キャッシュはモデル呼び出しを省くため、計測中は無効化する
+os.environ.setdefault("CAREPLAN_CACHE", "0")
+
+from openai import OpenAI
+from benchmarks.mock_server import MockConfig, start_server
+from metrics import percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, "corpus.jsonl")
+BASELINE = os.path.join(HERE, "baseline.json")
+FORMATS = ["SOAP形式", "看護計画表形式", "両方"]
+QUESTIONS = [
+    "短期目標の根拠を教えてください",
+    "介入の頻度とタイミングを要約して",
+    "SOAPのAの要点は？",
+    "なぜこの看護診断を優先したのですか",
+]
+MALFORMED_SAMPLES = [
+    '{"soap": {"assessment": ["a"], "plan": ["p"]}}',
+    '```json\n{"soap": {"assessment": ["a"], "plan": ["p"]}}\n```',
+    '{"soap": {"assessment": ["a",], "plan": ["p"],}}',
+    '{"soap": {"assessment": ["a"], "plan": ["p"',
+]
+
+def load_corpus(path: str = CORPUS) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _stats(latencies: list, errors: int, elapsed: float, peak_bytes: int) -> dict:
+    ms = [x * 1000 for x in latencies]
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(ms, 0.5), 2) if ms else None,
+        "p95_ms": round(percentile(ms, 0.95), 2) if ms else None,
+        "peak_mem_kb": round(peak_bytes / 1024, 1),
+    }
+
+def measure(fn, jobs: list, concurrency: int = 1) -> dict:
+    """jobs の各要素で fn を呼び、1件ごとのレイテンシと全体のスループットを測る"""
+    latencies, errors = [], 0
+
+    def one(job):
+        t0 = time.perf_counter()
+        ok = fn(job)
+        return time.perf_counter() - t0, ok
+
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, jobs))
+    else:
+        results = [one(job) for job in jobs]
+    elapsed = time.perf_counter() - started
+    for latency, ok in results:
+        latencies.append(latency)
+        errors += 0 if ok else 1
+    return _stats(latencies, errors, elapsed, tracemalloc.get_traced_memory()[1])
+
+def run_benchmarks(args) -> dict:
+    import inference
+    from utils import json_loads_safe
+
+    server, base_url = start_server(MockConfig(args.latency_ms, args.tokens_per_sec, args.malformed_rate, args.seed))
+    client = OpenAI(api_key="mock", base_url=base_url, max_retries=0)
+    corpus = load_corpus(args.corpus)
+    jobs = [(rec["patient_text"], fmt) for rec in corpus for fmt in FORMATS] * args.repeats
+    results = {}
+
+    plans = []
+    def gen(job):
+        result = inference.generate_care_plan(client, *job)
+        if "error" not in result:
+            plans.append((job, result))
+        return "error" not in result
+    results["generate_care_plan"] = measure(gen, jobs, args.concurrency)
+
+    def gen_stream(job):
+        return "error" not in inference.generate_care_plan(client, *job, on_partial=lambda partial: None)
+    results["generate_care_plan_stream"] = measure(gen_stream, jobs, args.concurrency)
+
+    last = [
+        {"patient_text": text, "output_format": fmt, **{k: plan[k] for k in ("soap", "plan_table", "reasoning_summary")}}
+        for (text, fmt), plan in plans[:len(corpus)]
+    ]
+    # 看護情報に1文追記して再送信（前回の結果を previous に渡す差分更新）
+    revisions = [(lo["patient_text"] + "\n追加: BT 37.9℃、夜間に不穏あり。", lo["output_format"], lo) for lo in last]
+    results["generate_care_plan_incremental"] = measure(
+        lambda job: "error" not in inference.generate_care_plan(client, job[0], job[1], previous=job[2]),
+        revisions * args.repeats, args.concurrency
+    )
+
+    followups = [(lo, q) for lo in last for q in QUESTIONS] * args.repeats
+    results["answer_followup"] = measure(
+        lambda job: "error" not in inference.answer_followup(client, job[0], job[1]), followups, args.concurrency
+    )
+
+    samples = MALFORMED_SAMPLES * 500
+    results["json_loads_safe"] = measure(lambda s: json_loads_safe(s) is not None, samples)
+
+    results.update(bench_history_render(last))
+    server.shutdown()
+    return results
+
+def bench_history_render(last: list) -> dict:
+    try:
+        import streamlit
+        import streamlit.logger
+        from components import history_timeline
+    except ImportError:
+        return {}
+    if not last:
+        return {}
+    # bare mode（streamlit run 外）での "missing ScriptRunContext" 警告を抑止
+    # （初回の st 呼び出しで設定が読み込まれログレベルが戻るため、空描画を1回挟んでから設定）
+    streamlit.empty()
+    streamlit.logger.set_log_level("error")
+    results = {}
+    for size in (10, 100, 500):
+        history = []
+        for i in range(size):
+            lo = last[i % len(last)]
+            if i % 2 == 0:
+                history.append({"type": "generation", "ts": f"2025-01-01T00:{i % 60:02d}:00+09:00", "payload": dict(lo)})
+            else:
+                history.append({"type": "followup", "ts": f"2025-01-01T00:{i % 60:02d}:30+09:00",
+                                "payload": {"question": QUESTIONS[i % len(QUESTIONS)], "answer": "回答" * 50}})
+        results[f"history_timeline_{size}"] = measure(lambda _: history_timeline(history) is None, range(20))
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """p95 の悪化・スループットの低下が許容幅を超えたシナリオを返す"""
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        if base.get("p95_ms") and cur.get("p95_ms") and cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {cur['p95_ms']}ms")
+        if base.get("throughput_rps") and cur.get("throughput_rps") and cur["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput_rps']} -> {cur['throughput_rps']} rps")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="モックサーバを用いたオフラインベンチマーク")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tokens-per-sec", type=float, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="許容する悪化率（0.2 = 20%%）")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    logging.getLogger("careplan.metrics").setLevel(logging.WARNING)
+    tracemalloc.start()
+    results = run_benchmarks(args)
+    tracemalloc.stop()
+
+    report = {
+        "python": platform.python_version(),
+        "settings": {k: getattr(args, k) for k in ("repeats", "concurrency", "latency_ms", "tokens_per_sec", "malformed_rate", "seed")},
+        "results": results,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved: {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+コールドスタートのベンチマーク（APIキー不要）。
+
+    python -m benchmarks.startup                   # 計測して baseline_startup.json と比較
+    python -m benchmarks.startup --save-baseline
+
+- import: 新しいプロセスでアプリのモジュール群を import するまでの時間（openai / httpx が読み込まれたかも記録）
+- first_paint: 新しいプロセスで streamlit.testing の AppTest により main.py を初回実行するまでの時間
+- rerun: 同じプロセスでの2回目の実行（再実行ごとのオーバーヘッド）
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run import compare
+from metrics import percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE = os.path.join(HERE, "baseline_startup.json")
+
+IMPORT_SCRIPT = """
+import sys, time, json
+t0 = time.perf_counter()
+import initialize, inference, components, utils, metrics
+elapsed = time.perf_counter() - t0
+print(json.dumps({"ms": elapsed * 1000, "openai": "openai" in sys.modules, "httpx": "httpx" in sys.modules}))
+"""
+
+PAINT_SCRIPT = """
+import sys, time, json
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(%r, default_timeout=60)
+at.run()
+first = time.perf_counter() - t0
+t1 = time.perf_counter()
+at.run()
+rerun = time.perf_counter() - t1
+print(json.dumps({"ms": first * 1000, "rerun_ms": rerun * 1000, "exception": bool(at.exception),
+                  "openai": "openai" in sys.modules}))
+"""
+
+def _run(script: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "startup-benchmark")
+    env["CAREPLAN_CACHE"] = "0"
+    out = subprocess.run(
+        [sys.executable, "-c", script], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def _stats(values: list, **extra) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.5), 1),
+        "p95_ms": round(percentile(values, 0.95), 1),
+        **extra,
+    }
+
+def run_benchmarks(repeats: int) -> dict:
+    imports = [_run(IMPORT_SCRIPT) for _ in range(repeats)]
+    paints = [_run(PAINT_SCRIPT % os.path.join(ROOT, "main.py")) for _ in range(repeats)]
+    return {
+        "import": _stats([r["ms"] for r in imports], openai_loaded=imports[-1]["openai"], httpx_loaded=imports[-1]["httpx"]),
+        "first_paint": _stats([r["ms"] for r in paints], openai_loaded=paints[-1]["openai"],
+                              errors=sum(1 for r in paints if r["exception"])),
+        "rerun": _stats([r["rerun_ms"] for r in paints]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="import 時間と初回描画の計測")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="許容する悪化率（0.2 = 20%%）")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "results": run_benchmarks(args.repeats)}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved: {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report["results"], json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_TTL_SEC = 6 * 60 * 60   # 1シフト程度
+
+def make_cache_key(messages: list, model: str, temperature: float) -> str:
+    """
+    プロンプト（messages）＋モデル設定から内容ベースのキーを作る。
+    改行コード・行末空白・Unicode正規化の差はキーに影響しない。
+    """
+    norm = [
+        {"role": m.get("role"), "content": _normalize_text(m.get("content") or "")}
+        for m in messages
+    ]
+    raw = json.dumps(
+        {"model": model, "temperature": temperature, "messages": norm},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+
+class ResponseCache:
+    """
+    プロセス内の LRU + TTL キャッシュ。値は JSON 化できる dict を想定し、取得時は複製を返す。
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_sec: float = DEFAULT_TTL_SEC):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # key -> (expires_at, json_str)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            found = self._data.get(key)
+            if found is not None and found[0] < time.time():
+                del self._data[key]
+                found = None
+            if found is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        return json.loads(found[1])
+
+    def set(self, key: str, value: dict):
+        blob = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl_sec, blob)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    SQLite ファイルに永続化するキャッシュ（再起動後も有効・同一ホストのセッション間で共有）。
+    LRU は last_used 列、TTL は expires_at 列で管理する。
+    """
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_sec: float = DEFAULT_TTL_SEC):
+        super().__init__(max_entries, ttl_sec)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")   # ファイルに記録されるため初回のみ
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache(
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_lru ON response_cache(last_used)")
+
+    @contextmanager
+    def _connect(self):
+        # 1操作ごとに開いて必ず閉じる（sqlite3 の with は commit / rollback のみで close しない）
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM response_cache WHERE key=? AND expires_at>=?", (key, now)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE response_cache SET last_used=? WHERE key=?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict):
+        now = time.time()
+        blob = json.dumps(value, ensure_ascii=False)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache(key, value, expires_at, last_used) VALUES(?,?,?,?)",
+                (key, blob, now + self.ttl_sec, now)
+            )
+            conn.execute("DELETE FROM response_cache WHERE expires_at<?", (now,))
+            conn.execute("""
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM response_cache")
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+def build_cache_from_env():
+    """
+    環境変数で設定:
+      CAREPLAN_CACHE          "0" で無効化
+      CAREPLAN_CACHE_PATH     指定時は SQLite バックエンド
+      CAREPLAN_CACHE_MAX      最大件数
+      CAREPLAN_CACHE_TTL_SEC  有効期限（秒）
+    """
+    if os.getenv("CAREPLAN_CACHE", "1") == "0":
+        return None
+    max_entries = int(os.getenv("CAREPLAN_CACHE_MAX", DEFAULT_MAX_ENTRIES))
+    ttl_sec = float(os.getenv("CAREPLAN_CACHE_TTL_SEC", DEFAULT_TTL_SEC))
+    path = os.getenv("CAREPLAN_CACHE_PATH")
+    if path:
+        return SQLiteResponseCache(path, max_entries, ttl_sec)
+    return ResponseCache(max_entries, ttl_sec)
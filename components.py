@@ -1,5 +1,16 @@
+import html
 import streamlit as st
 from datetime import datetime
+from collections import OrderedDict
+from history_store import payload_digest
+
+PLAN_TABLE_COLUMNS = {
+    "problems": "看護問題（NANDA-I）",
+    "assessments": "アセスメント（根拠）",
+    "goals": "目標（NOC）",
+    "interventions": "看護介入（NIC）",
+    "evaluation": "評価",
+}
 
 def app_header():
     with st.container():
@@ -45,6 +56,41 @@ def output_section_plan_table(plan_table):
         })
     st.table(rows)
 
+def live_plan_view(output_format: str):
+    """
+    ストリーミング生成中の途中結果を表示するプレースホルダを用意し、更新関数を返す。
+    返り値の関数に途中結果（generate_care_plan の on_partial と同じ dict）を渡すと再描画します。
+    """
+    note_ph = st.empty()
+    soap_ph = st.empty() if output_format in ("SOAP形式", "両方") else None
+    table_ph = st.empty() if output_format in ("看護計画表形式", "両方") else None
+
+    def update(partial: dict):
+        draft = partial.get("draft")
+        if draft:
+            note_ph.caption(f"類似する過去の計画（類似度 {draft.get('similarity', 0):.0%}）を下書きとして表示中。生成が完了すると置き換わります。")
+        else:
+            note_ph.empty()
+        if soap_ph is not None and any(partial.get("soap", {}).values()):
+            with soap_ph.container():
+                output_section_soap(partial["soap"])
+        if table_ph is not None and any(partial.get("plan_table", {}).values()):
+            with table_ph.container():
+                output_section_plan_table(partial["plan_table"])
+    return update
+
+def live_answer_view():
+    """
+    フォローアップ回答をトークン単位で描画するプレースホルダを用意し、断片を受け取る関数を返す。
+    """
+    ph = st.empty()
+    parts = []
+
+    def on_delta(delta: str):
+        parts.append(delta)
+        ph.markdown("".join(parts) + "▌")
+    return on_delta
+
 def followup_box(nonce: int):
     """
     フォローアップ質問入力欄。
@@ -56,6 +102,18 @@ def followup_box(nonce: int):
         placeholder="例：目標設定の短期目標の根拠を教えてください"
     )
 
+def retrieval_toggle():
+    return st.checkbox(
+        "類似する過去の計画を活用（ほぼ同一なら下書きを即時表示）", value=True,
+        help="過去に生成した計画（匿名化済み）から類似症例を検索します。"
+    )
+
+def incremental_toggle():
+    return st.checkbox(
+        "前回からの変更分のみ再生成", value=True,
+        help="看護情報の追記・修正が一部だけなら、影響する問題と SOAP の項目だけを再生成して前回の結果に統合します。"
+    )
+
 def end_session_box():
     return st.button("🔚 終了", use_container_width=True)
 
@@ -64,52 +122,150 @@ def show_toast(msg, variant="ok"):
     st.markdown(f'<div class="{color}">{msg}</div>', unsafe_allow_html=True)
 
 # ========== Conversation history UI ==========
-def history_timeline(history: list):
+HISTORY_FULL_WINDOW = 5      # 全文表示する最新カード数
+HISTORY_PAGE_SIZE = 20       # 折りたたみ一覧の1ページ件数
+_CARD_MEMO_MAX = 512
+_card_memo = OrderedDict()   # (type, ts, digest) -> 描画済みHTML（セッション横断で共有）
+
+def history_timeline(history: list, window: int = HISTORY_FULL_WINDOW):
     """
     Render session-scoped conversation history.
-    history: list of dicts with keys:
+    history: list (or history_store.HistoryStore) of entries with keys:
       - type: "generation" | "followup"
       - ts: ISO string
-      - payload: dict (depends on type)
+      - payload: dict (depends on type; loaded lazily if spilled to disk)
+      - summary: optional one-line label used for collapsed entries
+    Only the newest `window` cards are rendered in full; older ones are listed as
+    one-line summaries (paginated) and rendered on demand, so rerun cost stays flat.
     """
-    for item in history:
-        ts = fmt_ts(item.get("ts"))
-        if item["type"] == "generation":
-            _render_generation_card(item["payload"], ts)
-        elif item["type"] == "followup":
-            _render_followup_card(item["payload"], ts)
-
-def _render_generation_card(payload: dict, ts: str):
-    with st.container():
-        st.markdown(f"##### 🧪 生成結果 <span class='chip'>{payload.get('output_format','')}</span> <span class='small-muted'>｜{ts}</span>", unsafe_allow_html=True)
-        st.markdown("<div class='bubble-u'><b>入力（患者情報）</b><br/>" + nl2br(payload.get("patient_text","（空）")) + "</div>", unsafe_allow_html=True)
-        # SOAP
-        if payload.get("output_format") in ("SOAP形式", "両方"):
-            st.markdown("<div class='section-title'>SOAP（A/P）</div>", unsafe_allow_html=True)
-            st.markdown("**A（Assessment）**")
-            st.markdown(render_bullets(payload.get("soap",{}).get("assessment")))
-            st.markdown("**P（Plan）**")
-            st.markdown(render_bullets(payload.get("soap",{}).get("plan")))
-        # 計画表
-        if payload.get("output_format") in ("看護計画表形式", "両方"):
-            st.markdown("<div class='section-title'>看護計画表</div>", unsafe_allow_html=True)
-            rows = []
-            n = max_len(payload.get("plan_table",{}))
-            for i in range(n):
-                rows.append({
-                    "看護問題（NANDA-I）": safe_get(payload.get("plan_table",{}), "problems", i),
-                    "アセスメント（根拠）": safe_get(payload.get("plan_table",{}), "assessments", i),
-                    "目標（NOC）": safe_get(payload.get("plan_table",{}), "goals", i),
-                    "看護介入（NIC）": safe_get(payload.get("plan_table",{}), "interventions", i),
-                    "評価": safe_get(payload.get("plan_table",{}), "evaluation", i),
-                })
-            st.table(rows)
+    n_full = min(len(history), window) if window else len(history)
+    older = history[:len(history) - n_full]
+    if older:
+        _render_older_entries(older)
+    for item in history[len(history) - n_full:]:
+        _render_card(item)
 
-def _render_followup_card(payload: dict, ts: str):
-    with st.container():
-        st.markdown(f"##### 💬 フォローアップ <span class='small-muted'>｜{ts}</span>", unsafe_allow_html=True)
-        st.markdown("<div class='bubble-u'><b>質問</b><br/>" + nl2br(payload.get("question","")) + "</div>", unsafe_allow_html=True)
-        st.markdown("<div class='bubble-a'><b>回答</b><br/>" + nl2br(payload.get("answer","")) + "</div>", unsafe_allow_html=True)
+def _render_card(item: dict):
+    ts = fmt_ts(item.get("ts"))
+    # 描画メモのキーは履歴レコードの digest（本文を毎回キーに組み立てない）
+    payload = item["payload"]
+    key = (item["type"], ts, item.get("digest") or payload_digest(payload))
+    if item["type"] == "generation":
+        _render_generation_card(payload, ts, key)
+    elif item["type"] == "followup":
+        _render_followup_card(payload, ts, key)
+
+def _render_older_entries(older: list):
+    with st.expander(f"過去の履歴（{len(older)}件）", expanded=False):
+        pages = max(1, -(-len(older) // HISTORY_PAGE_SIZE))
+        page = 1
+        if pages > 1:
+            page = st.number_input("ページ（1 = 最新）", min_value=1, max_value=pages, value=1, step=1, key="hist_page")
+        end = len(older) - (page - 1) * HISTORY_PAGE_SIZE
+        start = max(0, end - HISTORY_PAGE_SIZE)
+        indexed = list(enumerate(older[start:end], start=start))[::-1]
+        st.markdown("<br>".join(_summary_line(i, item) for i, item in indexed), unsafe_allow_html=True)
+        pick = st.selectbox(
+            "詳細を表示", options=[None] + [i for i, _ in indexed],
+            format_func=lambda i: "（選択してください）" if i is None else f"#{i + 1}",
+            key=f"hist_pick_{page}"
+        )
+        if pick is not None:
+            _render_card(older[pick])
+
+def _summary_line(i: int, item) -> str:
+    # 要約は履歴レコードが保持する summary を使う（退避済みの payload を読み戻さない）
+    summary = item.get("summary")
+    if summary is None:
+        payload = item.get("payload", {})
+        summary = payload.get("patient_text") if item["type"] == "generation" else payload.get("question")
+    icon = "🧪" if item["type"] == "generation" else "💬"
+    return f"<span class='small-muted'>#{i + 1}｜{fmt_ts(item.get('ts'))}</span> {icon} {_snippet(summary)}"
+
+def _snippet(text: str, n: int = 40) -> str:
+    text = " ".join((text or "").split())
+    return html.escape(text[:n] + ("…" if len(text) > n else ""))
+
+def _memo_html(key: tuple, build):
+    found = _card_memo.get(key)
+    if found is None:
+        found = build()
+        _card_memo[key] = found
+        if len(_card_memo) > _CARD_MEMO_MAX:
+            _card_memo.popitem(last=False)
+    else:
+        _card_memo.move_to_end(key)
+    return found
+
+def _render_generation_card(payload: dict, ts: str, key: tuple):
+    st.markdown(_memo_html(key, lambda: _generation_card_html(payload, ts)), unsafe_allow_html=True)
+
+def _generation_card_html(payload: dict, ts: str) -> str:
+    fmt = payload.get("output_format", "")
+    parts = [
+        f"<h5>🧪 生成結果 <span class='chip'>{fmt}</span>{_incremental_chip(payload)} <span class='small-muted'>｜{ts}</span></h5>",
+        "<div class='bubble-u'><b>入力（患者情報）</b><br/>" + _esc_br(payload.get("patient_text") or "（空）") + "</div>",
+    ]
+    # SOAP
+    if fmt in ("SOAP形式", "両方"):
+        soap = payload.get("soap") or {}
+        parts.append("<div class='section-title'>SOAP（A/P）</div>")
+        parts.append("<b>A（Assessment）</b>" + _bullets_html(soap.get("assessment")))
+        parts.append("<b>P（Plan）</b>" + _bullets_html(soap.get("plan")))
+    # 計画表
+    if fmt in ("看護計画表形式", "両方"):
+        plan_table = payload.get("plan_table") or {}
+        parts.append("<div class='section-title'>看護計画表</div>")
+        head = "".join(f"<th>{h}</th>" for h in PLAN_TABLE_COLUMNS.values())
+        body = "".join(
+            "<tr>" + "".join(f"<td>{_esc_br(safe_get(plan_table, k, i))}</td>" for k in PLAN_TABLE_COLUMNS) + "</tr>"
+            for i in range(max_len(plan_table))
+        )
+        parts.append(f"<table class='generated'><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>")
+    return "\n".join(parts)
+
+def _incremental_chip(payload: dict) -> str:
+    inc = payload.get("incremental")
+    if not inc:
+        return ""
+    return f" <span class='chip'>差分更新（追加 {inc.get('added', 0)}・削除 {inc.get('removed', 0)} 文）</span>"
+
+def _render_followup_card(payload: dict, ts: str, key: tuple):
+    st.markdown(_memo_html(key, lambda: _followup_card_html(payload, ts)), unsafe_allow_html=True)
+
+def _followup_card_html(payload: dict, ts: str) -> str:
+    return "\n".join([
+        f"<h5>💬 フォローアップ <span class='small-muted'>｜{ts}</span></h5>",
+        "<div class='bubble-u'><b>質問</b><br/>" + nl2br(payload.get("question","")) + "</div>",
+        "<div class='bubble-a'><b>回答</b><br/>" + nl2br(payload.get("answer","")) + "</div>",
+    ])
+
+# ========== Admin metrics ==========
+def metrics_panel(summary: dict, extras: dict, prometheus_text: str):
+    """
+    管理者向けの計測パネル（サイドバー）。
+    summary: metrics.summary() / extras: 名前 → dict（キャッシュ・usage・接続プール等）
+    """
+    with st.sidebar.expander("📈 メトリクス（管理者）", expanded=False):
+        rows = []
+        for name, row in summary.items():
+            rows.append({
+                "対象": name,
+                "件数": row["count"],
+                "エラー": row["errors"],
+                "p50 (ms)": row.get("total_ms_p50"),
+                "p95 (ms)": row.get("total_ms_p95"),
+                "TTFT p50": row.get("ttft_ms_p50"),
+                "TTFT p95": row.get("ttft_ms_p95"),
+            })
+        if rows:
+            st.table(rows)
+        else:
+            st.caption("まだ記録がありません。")
+        for title, values in extras.items():
+            st.markdown(f"**{title}**")
+            st.json(values, expanded=False)
+        st.download_button("Prometheus 形式で保存", prometheus_text, file_name="careplan_metrics.prom", mime="text/plain")
 
 # helpers
 def render_bullets(items):
@@ -132,6 +288,13 @@ def safe_get(dic, key, idx):
 def nl2br(text: str) -> str:
     return (text or "").replace("\n", "<br>")
 
+def _esc_br(text: str) -> str:
+    return nl2br(html.escape(text or ""))
+
+def _bullets_html(items) -> str:
+    if not items: return "<p><i>該当なし</i></p>"
+    return "<ul>" + "".join(f"<li>{_esc_br(x)}</li>" for x in items) + "</ul>"
+
 def fmt_ts(iso_ts: str) -> str:
     try:
         return datetime.fromisoformat(iso_ts).strftime("%Y-%m-%d %H:%M")
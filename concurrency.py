@@ -0,0 +1,174 @@
+"""
+推論呼び出しの同時実行制御（プロセス内）。
+
+- SingleFlight: 同じキー（プロンプトのハッシュ）の呼び出しが実行中なら、新たに API を呼ばず
+  実行中の1件の結果を共有する（送信ボタンの二度押し・同一セッションの複数タブ）
+- FairLimiter: プロセス全体とユーザーごとの同時実行数の上限。空きを待つ間はユーザー単位の
+  ラウンドロビンで順番を回し、1人のバーストが他のユーザーの待ちを押し出さないようにする
+"""
+import os
+import time
+import threading
+from collections import OrderedDict, deque, defaultdict
+from contextlib import contextmanager
+
+MAX_CONCURRENCY = int(os.getenv("CAREPLAN_MAX_CONCURRENCY", "8"))
+MAX_CONCURRENCY_PER_USER = int(os.getenv("CAREPLAN_MAX_CONCURRENCY_PER_USER", "2"))
+QUEUE_TIMEOUT_SEC = float(os.getenv("CAREPLAN_QUEUE_TIMEOUT_SEC", "120"))
+
+class QueueTimeout(Exception):
+    def __str__(self):
+        return "混雑のため順番待ちがタイムアウトしました。しばらくしてから再度お試しください。"
+
+class _Call:
+    __slots__ = ("done", "result", "error", "aborted")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.aborted = False
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "shared": 0}
+
+    def do(self, key: str, fn):
+        """
+        fn() を実行して (result, shared) を返す。同じ key が実行中なら完了を待ってその結果を共有する（shared=True）。
+        実行側が中断された場合（Streamlit の再実行による停止など）は、待っていた側が自分で実行し直す。
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self._counters["calls"] += 1
+            if leader:
+                return self._run(key, call, fn), False
+            call.done.wait()
+            if call.aborted:
+                continue
+            with self._lock:
+                self._counters["shared"] += 1
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+    def _run(self, key: str, call: _Call, fn):
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.aborted = True
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+class FairLimiter:
+    def __init__(self, limit: int = MAX_CONCURRENCY, per_user: int = MAX_CONCURRENCY_PER_USER,
+                 timeout_sec: float = QUEUE_TIMEOUT_SEC):
+        self.limit = limit
+        self.per_user = per_user
+        self.timeout_sec = timeout_sec
+        self._cond = threading.Condition()
+        self._active = 0
+        self._active_by_user = defaultdict(int)
+        self._queues = OrderedDict()   # user -> 待ち行列（先頭のユーザーほど優先）
+        self._counters = {"acquired": 0, "queued": 0, "timeouts": 0, "wait_ms_total": 0.0, "peak_waiting": 0}
+
+    @contextmanager
+    def slot(self, user: str = None):
+        """
+        with limiter.slot(user) as wait_ms: ...  空きが出るまで待ち、待った時間（ms）を渡す。
+        user=None（UI 外の呼び出し）はプロセス全体の上限のみ適用する
+        """
+        ticket = object()
+        t0 = time.perf_counter()
+        with self._cond:
+            self._queues.setdefault(user, deque()).append(ticket)
+            waiting = sum(len(q) for q in self._queues.values())
+            self._counters["peak_waiting"] = max(self._counters["peak_waiting"], waiting)
+            if not self._can_run(user, ticket):
+                self._counters["queued"] += 1
+            deadline = t0 + self.timeout_sec
+            while not self._can_run(user, ticket):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._dequeue(user, ticket)
+                    self._counters["timeouts"] += 1
+                    self._cond.notify_all()
+                    raise QueueTimeout()
+                self._cond.wait(remaining)
+            self._dequeue(user, ticket)
+            # 実行を始めたユーザーは順番を最後尾へ（ラウンドロビン）
+            if user in self._queues:
+                self._queues.move_to_end(user)
+            self._active += 1
+            self._active_by_user[user] += 1
+            wait_ms = (time.perf_counter() - t0) * 1000
+            self._counters["acquired"] += 1
+            self._counters["wait_ms_total"] += wait_ms
+        try:
+            yield wait_ms
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._active_by_user[user] -= 1
+                if not self._active_by_user[user]:
+                    del self._active_by_user[user]
+                self._cond.notify_all()
+
+    def _can_run(self, user: str, ticket) -> bool:
+        if self._active >= self.limit or self._queues[user][0] is not ticket:
+            return False
+        # 上限に達していない待ちユーザーのうち、最も優先度の高いユーザーだけが実行できる
+        for other in self._queues:
+            if other is None or self._active_by_user.get(other, 0) < self.per_user:
+                return other == user
+        return False
+
+    def _dequeue(self, user: str, ticket):
+        q = self._queues[user]
+        q.remove(ticket)
+        if not q:
+            del self._queues[user]
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "active": self._active,
+                "waiting": sum(len(q) for q in self._queues.values()),
+                "limit": self.limit,
+                "per_user": self.per_user,
+            })
+        total = stats.pop("wait_ms_total")
+        stats["wait_ms_avg"] = round(total / stats["acquired"], 1) if stats["acquired"] else 0.0
+        return stats
+
+_inflight = SingleFlight()
+_limiter = FairLimiter()
+
+def get_inflight() -> SingleFlight:
+    return _inflight
+
+def get_limiter() -> FairLimiter:
+    return _limiter
+
+def concurrency_stats() -> dict:
+    return {"single_flight": _inflight.stats(), "limiter": _limiter.stats()}
@@ -0,0 +1,205 @@
+"""
+セッション内の会話履歴ストア。
+
+- 各エントリは __slots__ 付きの軽量レコード（HistoryEntry）。生成結果の payload は
+  last_outputs と同じ dict を共有し、二重に保持しない
+- セッションごとのメモリ上限（CAREPLAN_HISTORY_MAX_BYTES）を超えたら、古い payload から
+  ローカルの SQLite ファイルへ退避し、タイムラインが必要としたときにだけ読み戻す
+- 退避ファイルはセッション終了（discard）・セッション破棄（ストアの解放）時に削除し、
+  取り残された古いファイルも CAREPLAN_HISTORY_SPILL_TTL_SEC を過ぎたら掃除する
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import weakref
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+HISTORY_MAX_BYTES = int(os.getenv("CAREPLAN_HISTORY_MAX_BYTES", str(2 * 1024 * 1024)))
+SPILL_DIR = os.getenv("CAREPLAN_HISTORY_SPILL_DIR") or os.path.join(tempfile.gettempdir(), "careplan_history")
+SPILL_TTL_SEC = float(os.getenv("CAREPLAN_HISTORY_SPILL_TTL_SEC", str(24 * 60 * 60)))
+SWEEP_INTERVAL_SEC = 60 * 60
+SUMMARY_CHARS = 40
+
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+@dataclass(slots=True)
+class HistoryEntry:
+    type: str                 # "generation" | "followup"
+    ts: str
+    summary: str              # 折りたたみ表示用の1行要約（退避後もメモリに残す）
+    size: int                 # payload の概算バイト数
+    digest: str               # payload の内容ハッシュ（描画メモのキー。追加時に1回だけ計算）
+    _payload: dict = None     # 退避済みなら None
+    _row: int = None          # 退避先の行ID
+    _store: "HistoryStore" = field(default=None, repr=False)
+
+    @property
+    def payload(self) -> dict:
+        if self._payload is None and self._store is not None:
+            # 退避済み: 必要なときだけディスクから読む（メモリには戻さない）
+            return self._store.load(self._row)
+        return self._payload
+
+    @property
+    def spilled(self) -> bool:
+        return self._payload is None
+
+    # 既存の dict 形式（item["type"] / item.get("ts")）との互換
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+class HistoryStore:
+    """セッション1つ分の履歴（list と同様に len / index / slice / iter が使える）"""
+    def __init__(self, session_id: str, max_bytes: int = HISTORY_MAX_BYTES, spill_dir: str = SPILL_DIR):
+        self.session_id = session_id
+        self.max_bytes = max_bytes
+        # 同じ session_id を復元した別タブとファイルを共有しない（片方の破棄で消えないように）
+        self.spill_path = os.path.join(spill_dir, f"{session_id}-{uuid.uuid4().hex[:8]}.sqlite")
+        self.entries = []
+        self.memory_bytes = 0
+        self.pinned = None   # last_outputs と共有中の payload（退避してもメモリは減らないため対象外）
+        self._lock = threading.Lock()
+        # セッション期限切れなどでストアが解放されたら退避ファイルも消す
+        self._finalizer = weakref.finalize(self, _remove_file, self.spill_path)
+        sweep_spill_dir(spill_dir)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, idx):
+        return self.entries[idx]
+
+    def append(self, type: str, ts: str, payload: dict) -> HistoryEntry:
+        entry = HistoryEntry(
+            type=type, ts=ts, summary=_summarize(type, payload), size=approx_size(payload),
+            digest=payload_digest(payload),
+            _payload=payload, _store=self
+        )
+        with self._lock:
+            self.entries.append(entry)
+            self.memory_bytes += entry.size
+            self._spill_over_limit()
+        return entry
+
+    def load(self, row: int) -> dict:
+        with self._connect() as conn:
+            found = conn.execute("SELECT payload FROM history WHERE id=?", (row,)).fetchone()
+        return json.loads(found[0]) if found else {}
+
+    def stats(self) -> dict:
+        spilled = sum(1 for e in self.entries if e.spilled)
+        return {
+            "entries": len(self.entries),
+            "in_memory": len(self.entries) - spilled,
+            "spilled": spilled,
+            "memory_bytes": self.memory_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def pin(self, payload: dict):
+        """last_outputs として保持し続ける payload を指定する（退避の対象から外す）"""
+        self.pinned = payload
+
+    def discard(self):
+        """履歴を破棄し、退避ファイルも削除する"""
+        with self._lock:
+            self.entries.clear()
+            self.memory_bytes = 0
+            self.pinned = None
+            _remove_file(self.spill_path)
+
+    def _spill_over_limit(self):
+        # 古い順に退避（最新エントリは last_outputs と共有しているため対象外）
+        for entry in self.entries[:-1]:
+            if self.memory_bytes <= self.max_bytes:
+                return
+            if entry.spilled or entry._payload is self.pinned:
+                continue
+            with self._connect() as conn:
+                entry._row = conn.execute(
+                    "INSERT INTO history(type, ts, payload) VALUES(?,?,?)",
+                    (entry.type, entry.ts, json.dumps(entry._payload, ensure_ascii=False))
+                ).lastrowid
+            entry._payload = None
+            self.memory_bytes -= entry.size
+
+    @contextmanager
+    def _connect(self):
+        # 1操作ごとに開いて必ず閉じる（sqlite3 の with は commit / rollback のみで close しない）
+        os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+        conn = sqlite3.connect(self.spill_path, timeout=5)
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS history(id INTEGER PRIMARY KEY, type TEXT, ts TEXT, payload TEXT)")
+                yield conn
+        finally:
+            conn.close()
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def sweep_spill_dir(spill_dir: str = SPILL_DIR, ttl_sec: float = SPILL_TTL_SEC, force: bool = False) -> int:
+    """
+    最終更新から ttl_sec を過ぎた退避ファイルを削除する（プロセス終了などで取り残された分）。
+    通常は HistoryStore 作成時に呼ばれ、SWEEP_INTERVAL_SEC に1回だけ実行する。削除件数を返す
+    """
+    global _last_sweep
+    now = time.time()
+    with _sweep_lock:
+        if not force and now - _last_sweep < SWEEP_INTERVAL_SEC:
+            return 0
+        _last_sweep = now
+    removed = 0
+    try:
+        names = os.listdir(spill_dir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(spill_dir, name)
+        if not name.endswith(".sqlite"):
+            continue
+        try:
+            if now - os.path.getmtime(path) > ttl_sec:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+def approx_size(obj) -> int:
+    """payload のおおよそのメモリ量（文字列は CJK を想定して1文字2バイト＋オーバーヘッド）"""
+    if isinstance(obj, str):
+        return 50 + 2 * len(obj)
+    if isinstance(obj, dict):
+        return 100 + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return 60 + sum(approx_size(x) for x in obj)
+    return 30
+
+def payload_digest(payload: dict) -> str:
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+def _summarize(type: str, payload: dict) -> str:
+    if type == "generation":
+        text = payload.get("patient_text")
+    else:
+        text = payload.get("question")
+    text = " ".join((text or "").split())
+    return text[:SUMMARY_CHARS] + ("…" if len(text) > SUMMARY_CHARS else "")
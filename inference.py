@@ -1,45 +1,573 @@
-from openai import OpenAI
-from utils import json_loads_safe
-from prompts import build_generation_prompt, build_followup_prompt
+from __future__ import annotations
+import os
+import json
+import queue
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from utils import json_loads_safe, validate_plan, expand_example_refs, diff_patient_text, PlanStreamParser
+from prompts import (
+    build_generation_prompt, build_followup_prompt, build_section_prompt, build_patch_prompt,
+    select_followup_context, plan_response_format, REQUIRED_SECTIONS, PLAN_SECTIONS
+)
+from cache import make_cache_key, build_cache_from_env
+from metrics import request_span, current_span
+from concurrency import get_inflight, get_limiter
+from retrieval import find_similar, index_plan, DRAFT_THRESHOLD
+from routing import Route, route, fast_route, cost_usd, FAST_MODEL
 
-MODEL = "gpt-4o-mini"
+if TYPE_CHECKING:
+    from openai import OpenAI   # 型注釈のみ（SDK の import は initialize.get_client まで遅延）
+
+MODEL = FAST_MODEL   # 既定のモデル（リクエストごとの選択は routing.route）
 TEMPERATURE = 0.1
+# JSON Schema による構造化出力（"0" で従来の json_object モード）
+STRUCTURED_OUTPUT = os.getenv("CAREPLAN_STRUCTURED_OUTPUT", "1") != "0"
+MAX_SECTION_RETRIES = 1
+# 「両方」のときはセクション群ごとに並列リクエストし、完了した順に表示する（"0" で単一リクエスト）
+PARALLEL_SECTIONS = os.getenv("CAREPLAN_PARALLEL_SECTIONS", "1") != "0"
+PARALLEL_SECTION_GROUPS = [["soap", "reasoning_summary"], ["plan_table"]]
+# 前回の結果がある再送信では、看護情報の差分に関係する項目だけを再生成する（"0" で常に全体を生成）
+INCREMENTAL = os.getenv("CAREPLAN_INCREMENTAL", "1") != "0"
+# 前回の看護情報との文字単位の一致率がこれ未満なら別の症例とみなして全体を生成する
+INCREMENTAL_MIN_RATIO = float(os.getenv("CAREPLAN_INCREMENTAL_MIN_RATIO", "0.6"))
+
+logger = logging.getLogger(__name__)
+
+_usage_totals = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+_usage_lock = threading.Lock()
+# plans: 生成数 / parse_failures: 初回出力に欠落・不正があった数
+# section_retries: セクション単位の再要求数 / failed_plans: 再要求でも埋まらずエラーを返した数（=再送が必要な無駄打ち）
+_parse_totals = {"plans": 0, "parse_failures": 0, "section_retries": 0, "failed_plans": 0}
+
+_cache = None
+_cache_ready = False
+
+def get_cache():
+    """プロセス共有の応答キャッシュ（初回呼び出し時に環境変数から構築。無効時は None）"""
+    global _cache, _cache_ready
+    if not _cache_ready:
+        _cache = build_cache_from_env()
+        _cache_ready = True
+    return _cache
+
+def usage_stats() -> dict:
+    """API が返した usage の累計（cached_tokens はプロンプトキャッシュに一致したトークン数）"""
+    with _usage_lock:
+        stats = dict(_usage_totals)
+    stats["cached_ratio"] = (stats["cached_tokens"] / stats["prompt_tokens"]) if stats["prompt_tokens"] else 0.0
+    stats["cost_usd"] = round(stats["cost_usd"], 6)
+    return stats
 
-def generate_care_plan(client: OpenAI, patient_text: str, output_format: str):
+def parse_stats() -> dict:
+    with _usage_lock:
+        stats = dict(_parse_totals)
+    plans = stats["plans"] or 1
+    stats["parse_failure_rate"] = stats["parse_failures"] / plans
+    stats["failed_plan_rate"] = stats["failed_plans"] / plans
+    return stats
+
+def cache_stats() -> dict:
+    cache = get_cache()
+    return cache.stats() if cache else {"backend": "disabled", "entries": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+
+def generate_care_plan(client: OpenAI, patient_text: str, output_format: str, on_partial=None, use_retrieval=True,
+                       user: str = None, previous: dict = None):
+    """
+    on_partial を渡すとストリーミングで生成し、リスト要素が1件確定するたびに
+    途中結果（soap / plan_table / reasoning_summary と同じ形の dict）で呼び出す。
+    use_retrieval=True なら過去の類似計画を参考例として渡し、同じ項目は参照で短く書かせる
+    （ほぼ同一なら生成の完了まで下書きとして on_partial に先に渡す。下書きを結果として返すことはない）。
+    同じ内容の生成が実行中なら、その結果を共有する（on_partial は完成結果で1回だけ呼ばれる）。
+    user（セッションID）ごとに同時実行数を制限し、空きが出るまで順番に待つ。
+    previous（直前の last_outputs）を渡すと、看護情報の変更が一部だけなら影響する項目のみを再生成し、
+    前回の計画に統合して返す（結果の "incremental" に差分の文数）。
+    """
+    with request_span("generation") as span:
+        return _generate_care_plan(client, patient_text, output_format, on_partial, span, use_retrieval, user, previous)
+
+def _generate_care_plan(client: OpenAI, patient_text: str, output_format: str, on_partial, span, use_retrieval=True,
+                        user: str = None, previous: dict = None):
     try:
         messages = build_generation_prompt(patient_text, output_format)
-        resp = client.chat.completions.create(
-            model=MODEL,
-            temperature=TEMPERATURE,
-            messages=messages,
-            response_format={"type":"json_object"}
-        )
-        content = resp.choices[0].message.content
-        data = json_loads_safe(content)
-        if not data:
-            return {"error": "出力の解析に失敗しました。入力内容を見直すか、再度実行してください。"}
-        data.setdefault("soap", {"assessment":[], "plan":[]})
-        data.setdefault("plan_table", {"problems":[], "assessments":[], "goals":[], "interventions":[], "evaluation":[]})
-        data.setdefault("reasoning_summary", {"key_findings":[], "rationales":[], "differentials":[]})
+        r = _routed(span, route("generation", patient_text))
+        cache = get_cache()
+        key = make_cache_key(messages, r.model, TEMPERATURE)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                span.set("cache_hit", True)
+                span.mark_first_token()
+                if on_partial is not None:
+                    on_partial(cached)
+                return cached
+        diff = _incremental_diff(previous, patient_text, output_format)
+        if diff is not None:
+            previous_plan = {sec: previous[sec] for sec in PLAN_SECTIONS if previous.get(sec)}
+            data, shared = get_inflight().do(
+                f"incremental:{key}:" + make_cache_key(
+                    [{"role": "assistant", "content": json.dumps(previous_plan, ensure_ascii=False)}], r.model, TEMPERATURE
+                ),
+                lambda: _generate_incremental(
+                    client, patient_text, output_format, previous_plan, diff, on_partial, span, user, r
+                )
+            )
+        else:
+            data, shared = get_inflight().do(
+                f"generation:{key}:{int(bool(use_retrieval))}",
+                lambda: _generate_uncached(
+                    client, patient_text, output_format, messages, on_partial, span, use_retrieval, cache, key, user, r
+                )
+            )
+        if shared:
+            _on_shared(span, data)
+            if on_partial is not None and "error" not in data:
+                on_partial(data)
+        elif "error" not in data:
+            # 類似検索の索引へは実際に生成した結果だけを載せる（キャッシュ・相乗りの結果は重複になるため除く）
+            index_plan(patient_text, output_format, data)
         return data
     except Exception as e:
+        logger.exception("generate_care_plan failed")
+        _mark_error(span, type(e).__name__)
         return {"error": f"生成に失敗しました: {e}"}
 
-def answer_followup(client: OpenAI, last_outputs: dict, question: str):
+def _generate_uncached(client: OpenAI, patient_text: str, output_format: str, messages: list, on_partial, span,
+                       use_retrieval: bool, cache, key: str, user: str, r: Route) -> dict:
+    example = None
+    match = find_similar(patient_text, output_format) if use_retrieval else None
+    if match is not None:
+        similarity, example = match
+        span.set("retrieval_similarity", round(similarity, 3))
+        span.set("retrieval", "example")
+        if similarity >= DRAFT_THRESHOLD and on_partial is not None:
+            # ほぼ同一の過去計画は仮の下書きとして先に表示し、生成結果で置き換える
+            # （文字 n-gram の類似度には検査値・バイタルの変化がほとんど表れないため、そのまま採用はしない）
+            draft = json.loads(json.dumps(example["plan"]))
+            draft["draft"] = {"similarity": round(similarity, 3)}
+            span.set("retrieval", "draft")
+            span.mark_first_token()
+            on_partial(draft)
+        messages = build_generation_prompt(patient_text, output_format, example)
+        if on_partial is not None:
+            on_partial = _expanding(on_partial, example["plan"])
+    cacheable = True
+    if on_partial is not None and r.speculative:
+        data, cacheable = _generate_speculative(
+            client, patient_text, output_format, messages, on_partial, example, r, span, user
+        )
+    else:
+        raw = _generate_raw(client, patient_text, output_format, messages, on_partial, example, r.model, user)
+        data = complete_plan(client, patient_text, output_format, raw, r.model, user)
+    if not data:
+        _mark_error(span, "ParseError")
+        return {"error": "出力の解析に失敗しました。入力内容を見直すか、再度実行してください。"}
+    if on_partial is not None:
+        on_partial(data)
+    if cache is not None and cacheable:
+        # FAST の下書きで代替した結果は STRONG のキーで保存しない（一時的な失敗が TTL の間残るため）
+        cache.set(key, data)
+    return data
+
+def _generate_incremental(client: OpenAI, patient_text: str, output_format: str, previous_plan: dict, diff: dict,
+                          on_partial, span, user: str, r: Route) -> dict:
+    # 前回の計画を "#番号" で参照させ、変更に関係する項目だけを書かせて統合する（並列生成・類似検索は使わない）
+    span.set("incremental", True)
+    span.set("changed_sentences", len(diff["added"]) + len(diff["removed"]))
+    messages = build_patch_prompt(patient_text, output_format, previous_plan, diff)
+    if on_partial is not None:
+        on_partial = _expanding(on_partial, previous_plan)
+    with _slot(user):
+        if on_partial is None:
+            raw = _complete_once(client, messages, r.model)
+        else:
+            raw = json_loads_safe(_stream_plan(client, messages, on_partial, r.model))
+    data = complete_plan(client, patient_text, output_format, expand_example_refs(raw, previous_plan), r.model, user)
+    if not data:
+        _mark_error(span, "ParseError")
+        return {"error": "出力の解析に失敗しました。入力内容を見直すか、再度実行してください。"}
+    data["incremental"] = {"added": len(diff["added"]), "removed": len(diff["removed"])}
+    if on_partial is not None:
+        on_partial(data)
+    return data
+
+def _incremental_diff(previous: dict, patient_text: str, output_format: str):
+    # 差分更新できる再送信なら diff を返す（前回と同じ出力形式・同じ症例とみなせる一致率のときのみ）
+    if not INCREMENTAL or not previous or previous.get("output_format") != output_format:
+        return None
+    old = previous.get("patient_text") or ""
+    if not old or old == patient_text or not any(previous.get(sec) for sec in PLAN_SECTIONS):
+        return None
+    diff = diff_patient_text(old, patient_text)
+    if diff["ratio"] < INCREMENTAL_MIN_RATIO or not (diff["added"] or diff["removed"]):
+        return None
+    return diff
+
+def _complete_once(client: OpenAI, messages: list, model: str):
+    span = current_span()
+    if span is not None:
+        span.mark_sent()
+    resp = client.chat.completions.create(
+        model=model,
+        temperature=TEMPERATURE,
+        messages=messages,
+        response_format=response_format_for()
+    )
+    _record_usage(resp.usage, model)
+    return json_loads_safe(resp.choices[0].message.content or "")
+
+def _generate_raw(client: OpenAI, patient_text: str, output_format: str, messages: list, on_partial,
+                  example: dict, model: str, user: str = None):
+    if PARALLEL_SECTIONS and output_format == "両方":
+        raw = _generate_parallel(client, patient_text, output_format, on_partial, model, example, user)
+    else:
+        with _slot(user):
+            if on_partial is None:
+                raw = _complete_once(client, messages, model)
+            else:
+                raw = json_loads_safe(_stream_plan(client, messages, on_partial, model))
+    if example is not None:
+        raw = expand_example_refs(raw, example["plan"])
+    return raw
+
+class _DraftCancelled(Exception):
+    pass
+
+def _generate_speculative(client: OpenAI, patient_text: str, output_format: str, messages: list, on_partial,
+                          example: dict, r: Route, span, user: str) -> tuple:
+    # FAST の下書きをストリーミング表示しながら STRONG で生成し、完成したら置き換える。
+    # (結果, STRONG の結果か) を返す。STRONG が失敗したときは下書きを完成させて代わりに返す。
+    # UI 更新は _generate_parallel と同じく呼び出し元（スクリプトスレッド）がキューを受けて行う。
+    # 同時実行数の枠は他の経路と同じく API 呼び出しごとに取る（下書きと本番が並行して1つずつ）。
+    fast = fast_route("speculative_draft")
+    span.set("speculative", True)
+    events = queue.Queue()
+    stop = threading.Event()
+    state_lock = threading.Lock()
+    draft_state = {"started": False, "streams": []}
+
+    def on_item(path, value):
+        if stop.is_set():
+            raise _DraftCancelled()   # 本番が完成したら下書きのストリームを閉じる
+        events.put(("item", path, value))
+
+    def on_stream(stream):
+        with state_lock:
+            draft_state["streams"].append(stream)
+        if stop.is_set():
+            stream.close()
+
+    def draft():
+        try:
+            with _slot(user):
+                with state_lock:
+                    if stop.is_set():
+                        return
+                    draft_state["started"] = True
+                content = _stream_plan(client, messages, None, fast.model, on_item=on_item, on_stream=on_stream)
+            events.put(("draft", None, json_loads_safe(content)))
+        except _DraftCancelled:
+            pass
+        except Exception as e:
+            if stop.is_set():
+                return   # 打ち切りのためにストリームを閉じた
+            logger.warning("speculative draft failed: %s", e)
+            events.put(("draft", None, None))
+
+    def final():
+        try:
+            raw = _generate_raw(client, patient_text, output_format, messages, None, example, r.model, user)
+            events.put(("final", None, complete_plan(client, patient_text, output_format, raw, r.model, user)))
+        except Exception as e:
+            logger.warning("strong model generation failed, falling back to the draft: %s", e)
+            events.put(("final", None, None))
+
+    def cancel_draft():
+        # span を閉じる前に下書きを止め、終わるまで待つ（閉じた span に usage を記録させない）
+        with state_lock:
+            stop.set()
+            started = draft_state["started"]
+            streams = list(draft_state["streams"])
+        for stream in streams:
+            stream.close()
+        if started:
+            draft_future.result()
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    draft_future = pool.submit(contextvars.copy_context().run, draft)
+    pool.submit(contextvars.copy_context().run, final)
+    pool.shutdown(wait=False)
+    partial = validate_plan(None)[0]
+    drafted, draft_done = None, False
     try:
-        context = {
-            "patient_text": last_outputs.get("patient_text"),
-            "soap": last_outputs.get("soap"),
-            "plan_table": last_outputs.get("plan_table"),
-            "reasoning_summary": last_outputs.get("reasoning_summary")
-        }
+        while True:
+            kind, path, value = events.get()
+            if kind == "item":
+                if len(path) == 2 and path[0] in partial:
+                    partial[path[0]].setdefault(path[1], []).append(value)
+                    on_partial(partial)
+            elif kind == "draft":
+                drafted, draft_done = value, True
+            elif value is not None:
+                return value, True
+            else:
+                break
+        # STRONG が失敗: 下書きの完成を待ってそれを採用する
+        while not draft_done:
+            kind, _, value = events.get()
+            if kind == "draft":
+                drafted, draft_done = value, True
+    finally:
+        cancel_draft()
+    span.set("route", "speculative_fallback")
+    span.set("model", fast.model)
+    if example is not None:
+        drafted = expand_example_refs(drafted, example["plan"])
+    return complete_plan(client, patient_text, output_format, drafted, fast.model, user), False
+
+def answer_followup(client: OpenAI, last_outputs: dict, question: str, on_delta=None, user: str = None):
+    """
+    on_delta を渡すとストリーミングで生成し、受信したテキスト断片ごとに呼び出す。
+    同じ質問の回答が実行中なら、その結果を共有する（on_delta は回答全文で1回だけ呼ばれる）。
+    """
+    with request_span("followup") as span:
+        return _answer_followup(client, last_outputs, question, on_delta, span, user)
+
+def _answer_followup(client: OpenAI, last_outputs: dict, question: str, on_delta, span, user: str = None):
+    try:
+        # 質問に関係するセクションだけをコンパクトなJSONで渡す
+        context, ctx_stats = select_followup_context(last_outputs, question)
+        logger.info(
+            "followup context: %d tokens (full %d, saved %d) sections=%s",
+            ctx_stats["context_tokens"], ctx_stats["full_tokens"], ctx_stats["saved_tokens"], ctx_stats["sections"]
+        )
+        span.set("context_tokens_saved", ctx_stats["saved_tokens"])
         messages = build_followup_prompt(context, question)
-        resp = client.chat.completions.create(
-            model=MODEL,
-            temperature=TEMPERATURE,
-            messages=messages
+        r = _routed(span, route("followup", question))
+        result, shared = get_inflight().do(
+            "followup:" + make_cache_key(messages, r.model, TEMPERATURE),
+            lambda: _followup_uncached(client, messages, on_delta, span, user, r.model)
         )
-        content = resp.choices[0].message.content
-        return {"answer": content}
+        if shared:
+            _on_shared(span, result)
+            if on_delta is not None:
+                on_delta(result["answer"])
+        return result
     except Exception as e:
+        logger.exception("answer_followup failed")
+        _mark_error(span, type(e).__name__)
         return {"error": f"回答生成に失敗しました: {e}"}
+
+def _followup_uncached(client: OpenAI, messages: list, on_delta, span, user: str, model: str) -> dict:
+    with _slot(user):
+        if on_delta is None:
+            span.mark_sent()
+            resp = client.chat.completions.create(
+                model=model,
+                temperature=TEMPERATURE,
+                messages=messages
+            )
+            _record_usage(resp.usage, model)
+            content = resp.choices[0].message.content
+        else:
+            parts = []
+            for delta in _iter_deltas(client, messages, model):
+                parts.append(delta)
+                on_delta(delta)
+            content = "".join(parts)
+    return {"answer": content}
+
+def parse_care_plan(content: str, output_format: str = None):
+    """
+    モデル出力（JSON文字列）を解析・検証し、欠けたセクションを補完する。
+    解析不能、または output_format で必須のセクションが不正・空なら None
+    """
+    plan, failed = validate_plan(json_loads_safe(content or ""), REQUIRED_SECTIONS.get(output_format, ()))
+    return None if failed else plan
+
+def response_format_for(sections=None) -> dict:
+    """生成リクエストの response_format（構造化出力が無効なら json_object）"""
+    return plan_response_format(sections) if STRUCTURED_OUTPUT else {"type":"json_object"}
+
+# ===== helpers =====
+def _mark_error(span, error_type: str):
+    span.set("status", "error")
+    span.set("error_type", error_type)
+
+@contextmanager
+def _slot(user: str):
+    # API 呼び出し1回ごとに同時実行数の空きを待つ（並列・再要求の呼び出しもそれぞれ1枠として数える）。
+    # 待ち時間は呼び出しごとに span の limiter_wait_ms へ合算する（最初の待ちは queue_ms にも含まれる）
+    with get_limiter().slot(user) as wait_ms:
+        span = current_span()
+        if span is not None:
+            span.add("limiter_wait_ms", wait_ms)
+        yield
+
+def _routed(span, r: Route) -> Route:
+    span.set("model", r.model)
+    span.set("route", r.reason)
+    return r
+
+def _on_shared(span, result: dict):
+    # 実行中の同一リクエストの結果を共有した（API は呼んでいない）
+    span.set("coalesced", True)
+    span.mark_first_token()
+    if "error" in result:
+        _mark_error(span, "ParseError")
+
+def _count(key: str, n: int = 1):
+    with _usage_lock:
+        _parse_totals[key] += n
+
+def complete_plan(client: OpenAI, patient_text: str, output_format: str, raw, model: str, user: str = None):
+    """
+    モデル出力 raw を検証し、失敗したセクションだけを再要求して埋める（全体の再生成はしない）。
+    埋められなければ None。batch.py からも使う（client は同期クライアント）。
+    """
+    plan, failed = validate_plan(raw, REQUIRED_SECTIONS.get(output_format, ()))
+    _count("plans")
+    if failed:
+        _count("parse_failures")
+        logger.warning("care plan sections failed validation: %s", failed)
+    for section in failed:
+        fixed = _retry_section(client, patient_text, output_format, section, model, user)
+        if fixed is None:
+            _count("failed_plans")
+            return None
+        plan[section] = fixed
+    return plan
+
+def _retry_section(client: OpenAI, patient_text: str, output_format: str, section: str, model: str,
+                   user: str = None):
+    messages = build_section_prompt(patient_text, output_format, [section])
+    for _ in range(MAX_SECTION_RETRIES):
+        _count("section_retries")
+        span = current_span()
+        if span is not None:
+            span.add("parse_retries")
+        with _slot(user):
+            if span is not None:
+                span.mark_sent()
+            resp = client.chat.completions.create(
+                model=model,
+                temperature=TEMPERATURE,
+                messages=messages,
+                response_format=response_format_for([section])
+            )
+        _record_usage(resp.usage, model)
+        plan, failed = validate_plan(json_loads_safe(resp.choices[0].message.content or ""), [section])
+        if not failed:
+            return plan[section]
+    return None
+
+def _record_usage(usage, model: str):
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    cost = cost_usd(model, usage.prompt_tokens or 0, cached, usage.completion_tokens or 0)
+    with _usage_lock:
+        _usage_totals["calls"] += 1
+        _usage_totals["prompt_tokens"] += usage.prompt_tokens or 0
+        _usage_totals["completion_tokens"] += usage.completion_tokens or 0
+        _usage_totals["cached_tokens"] += cached
+        _usage_totals["cost_usd"] += cost
+    span = current_span()
+    if span is not None:
+        span.add("prompt_tokens", usage.prompt_tokens or 0)
+        span.add("completion_tokens", usage.completion_tokens or 0)
+        span.add("cached_tokens", cached)
+        span.add("cost_usd", cost)
+
+def _iter_deltas(client: OpenAI, messages: list, model: str, on_stream=None, **kwargs):
+    span = current_span()
+    if span is not None:
+        span.mark_sent()
+    stream = client.chat.completions.create(
+        model=model,
+        temperature=TEMPERATURE,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+        **kwargs
+    )
+    if on_stream is not None:
+        on_stream(stream)   # 別スレッドから打ち切れるように渡す
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                _record_usage(chunk.usage, model)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if span is not None:
+                    span.mark_first_token()
+                yield delta
+    finally:
+        stream.close()   # 途中で抜けた場合も接続をプールへ返す
+
+def _stream_plan(client: OpenAI, messages: list, on_partial, model: str, sections=None, on_item=None,
+                 on_stream=None) -> str:
+    parser = PlanStreamParser()
+    partial = validate_plan(None)[0]
+    parts = []
+    for delta in _iter_deltas(client, messages, model, on_stream, response_format=response_format_for(sections)):
+        parts.append(delta)
+        items = parser.feed(delta)
+        for path, value in items:
+            if on_item is not None:
+                on_item(path, value)
+            elif len(path) == 2 and path[0] in partial:
+                partial[path[0]].setdefault(path[1], []).append(value)
+        if items and on_partial is not None:
+            on_partial(partial)
+    return "".join(parts)
+
+def _expanding(on_partial, example_plan: dict):
+    # ストリーミング途中の "#番号" 参照も参考例の本文に置き換えて表示する
+    return lambda partial: on_partial(expand_example_refs(partial, example_plan))
+
+def _generate_parallel(client: OpenAI, patient_text: str, output_format: str, on_partial, model: str,
+                       example: dict = None, user: str = None) -> dict:
+    # 各セクション群を別スレッドでストリーミング生成（同時実行数の枠はセクション群ごとに取る）。UI 更新はスレッドから直接行わず、
+    # 呼び出し元（Streamlit のスクリプトスレッド）がキューを受けて on_partial を呼ぶ。
+    events = queue.Queue()
+
+    def run(sections):
+        try:
+            messages = build_section_prompt(patient_text, output_format, sections, example)
+            with _slot(user):
+                content = _stream_plan(
+                    client, messages, None, model, sections=sections,
+                    on_item=lambda path, value: events.put(("item", path, value))
+                )
+            events.put(("done", sections, json_loads_safe(content)))
+        except Exception as e:
+            # 失敗したセクションは complete_plan の再要求で補う
+            logger.warning("parallel section request %s failed: %s", sections, e)
+            events.put(("done", sections, None))
+
+    partial = validate_plan(None)[0]
+    merged = {}
+    with ThreadPoolExecutor(max_workers=len(PARALLEL_SECTION_GROUPS)) as pool:
+        for sections in PARALLEL_SECTION_GROUPS:
+            # 計測コンテキストをワーカースレッドへ引き継ぐ
+            pool.submit(contextvars.copy_context().run, run, sections)
+        pending = len(PARALLEL_SECTION_GROUPS)
+        while pending:
+            kind, key, value = events.get()
+            if kind == "item":
+                if len(key) == 2 and key[0] in partial:
+                    partial[key[0]].setdefault(key[1], []).append(value)
+                    if on_partial is not None:
+                        on_partial(partial)
+                continue
+            pending -= 1
+            if isinstance(value, dict):
+                merged.update({sec: value.get(sec) for sec in key if sec in value})
+    return merged
@@ -1,53 +1,162 @@
 import os
-from dotenv import load_dotenv
+import re
+import threading
+from typing import TYPE_CHECKING
 import streamlit as st
-from openai import OpenAI
+from worker_client import worker_url
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# openai / httpx は読み込みに時間がかかるため、初回の送信（get_client）まで import しない
+# （dotenv は各入口 main.py / worker.py / batch.py の先頭で、他のモジュールより先に読み込む）
+
+# HTTP 接続設定（ここで一元管理。環境変数で上書き可）
+HTTP_MAX_CONNECTIONS = int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "64"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE", "32"))
+HTTP_KEEPALIVE_EXPIRY_SEC = float(os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY_SEC", "60"))
+HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv("OPENAI_HTTP_CONNECT_TIMEOUT_SEC", "5"))
+HTTP_READ_TIMEOUT_SEC = float(os.getenv("OPENAI_HTTP_READ_TIMEOUT_SEC", "60"))
+HTTP_POOL_TIMEOUT_SEC = float(os.getenv("OPENAI_HTTP_POOL_TIMEOUT_SEC", "10"))
+
+_pool_counters = {"requests": 0, "peak_active_connections": 0}
+_pool_lock = threading.Lock()
+_http_client = None
+_env_loaded = False
+_env_lock = threading.Lock()
 
 def load_env():
-    # Local: .env → os.environ / Deploy: Streamlit Secrets
-    load_dotenv(override=False)
-    if "OPENAI_API_KEY" not in os.environ and "OPENAI_API_KEY" in st.secrets:
-        os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
+    # Deploy: Streamlit Secrets → os.environ（プロセスごとに1回だけ解決する）。.env は main.py の先頭で反映済み
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if _env_loaded:
+            return
+        # 推論ワーカー利用時は UI 側に API キーは不要
+        if not worker_url() and "OPENAI_API_KEY" not in os.environ and "OPENAI_API_KEY" in st.secrets:
+            os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
+        _env_loaded = True
 
-def get_client():
+def require_api_key() -> str:
+    if worker_url():
+        return None
     api_key = os.getenv("OPENAI_API_KEY", None)
     if not api_key:
         st.error("OpenAI APIキーが設定されていません。Secrets または .env を確認してください。")
         st.stop()
-    return OpenAI(api_key=api_key)
+    return api_key
+
+def get_client():
+    """OpenAI クライアント（INFERENCE_WORKER_URL 指定時は推論ワーカーのクライアント）"""
+    url = worker_url()
+    if url:
+        return _shared_worker(url)
+    return _shared_client(require_api_key())
+
+def get_inference():
+    """推論の呼び出し先モジュール（ワーカー利用時は worker_client、それ以外はプロセス内の inference）"""
+    if worker_url():
+        import worker_client
+        return worker_client
+    import inference
+    return inference
+
+@st.cache_resource(show_spinner=False)
+def _shared_worker(url: str):
+    from worker_client import WorkerClient
+    return WorkerClient(url)
+
+@st.cache_resource(show_spinner=False)
+def _shared_client(api_key: str) -> "OpenAI":
+    # 再実行・セッションをまたいで1つのクライアント（=接続プール）を共有する
+    return build_openai_client(api_key)
+
+def build_openai_client(api_key: str = None) -> "OpenAI":
+    """接続プール設定済みのクライアント（推論ワーカーはプロセスごとにこれを1つ作る）"""
+    import httpx
+    from openai import OpenAI
+    global _http_client
+    _http_client = httpx.Client(
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SEC,
+        ),
+        timeout=httpx.Timeout(
+            HTTP_READ_TIMEOUT_SEC, connect=HTTP_CONNECT_TIMEOUT_SEC, pool=HTTP_POOL_TIMEOUT_SEC
+        ),
+        event_hooks={"request": [_on_request]},
+    )
+    return OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), http_client=_http_client)
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (httpx[http2] 導入時のみ HTTP/2 を有効化)
+        return True
+    except ImportError:
+        return False
+
+def _on_request(request):
+    active = _pool_stats_raw()[1]
+    with _pool_lock:
+        _pool_counters["requests"] += 1
+        _pool_counters["peak_active_connections"] = max(_pool_counters["peak_active_connections"], active + 1)
+
+def _pool_stats_raw():
+    # httpcore の接続プールを参照（非公開属性のため取得できなければ 0 扱い）
+    pool = getattr(getattr(_http_client, "_transport", None), "_pool", None)
+    conns = list(getattr(pool, "connections", None) or [])
+    idle = sum(1 for c in conns if c.is_idle())
+    return len(conns), len(conns) - idle, idle
+
+def get_pool_stats() -> dict:
+    """接続プールの利用状況（同時接続数のサイジング用）"""
+    with _pool_lock:
+        stats = dict(_pool_counters)
+    stats.update({
+        "max_connections": HTTP_MAX_CONNECTIONS,
+        "max_keepalive": HTTP_MAX_KEEPALIVE,
+        "http2": _http2_available(),
+    })
+    stats["open_connections"], stats["active_connections"], stats["idle_connections"] = _pool_stats_raw()
+    return stats
+
+# ライトテーマ固定（ダークモード切替なし）。静的なので import 時に1回だけ組み立てる
+BASE_STYLES = re.sub(r"\n\s*", "", """
+<style>
+  :root{
+    --primary:#0ea5a4;   /* teal-ish medical */
+    --accent:#2563eb;
+    --warn:#d97706;
+    --error:#dc2626;
+    --card-bg:#ffffff;
+    --text:#111827;
+    --muted:#6b7280;
+    --border:#e5e7eb;
+  }
+  .app-title{font-weight:800;font-size:2rem;color:var(--primary);}
+  .pill{display:inline-block;padding:.2rem .6rem;border-radius:9999px;background:var(--primary);color:#fff;font-weight:700}
+  .card{background:var(--card-bg);border:1px solid var(--border);border-radius:14px;padding:16px;margin-bottom:12px;box-shadow:0 1px 3px rgba(0,0,0,0.06)}
+  .muted{color:var(--muted)}
+  .section-title{font-weight:800;border-left:4px solid var(--accent);padding-left:.5rem;margin:1rem 0 .5rem}
+  .tag{display:inline-block;border:1px solid var(--border);border-radius:10px;padding:.2rem .5rem;margin-right:.3rem}
+  .thinking{display:inline-block; font-weight:700}
+  .thinking::after{content:""; display:inline-block; width:1em; text-align:left; animation: dots 1.2s steps(4,end) infinite}
+  @keyframes dots{0%{content:""}25%{content:"."}50%{content:".."}75%{content:"..."}}
+  .ok{color:var(--primary);font-weight:700}
+  .warn{color:var(--warn);font-weight:700}
+  .error{color:var(--error);font-weight:700}
+  table.generated{width:100%; border-collapse:collapse}
+  table.generated th, table.generated td{border:1px solid var(--border); padding:.5rem; vertical-align:top}
+  table.generated th{background:rgba(37,99,235,0.08)}
+  .bubble-u{background:#eef7f7;border:1px solid var(--border);padding:.6rem .8rem;border-radius:14px}
+  .bubble-a{background:#f6f7ff;border:1px solid var(--border);padding:.6rem .8rem;border-radius:14px}
+  .small-muted{color:var(--muted); font-size:.85rem}
+  .chip{display:inline-block;background:rgba(14,165,164,0.1); color:#0ea5a4; border:1px solid #c7ecea; border-radius:999px; padding:.1rem .5rem; margin-left:.3rem}
+</style>
+""")
 
 def inject_base_styles():
-    # ライトテーマ固定（ダークモード切替なし）
-    st.markdown("""
-    <style>
-      :root{
-        --primary:#0ea5a4;   /* teal-ish medical */
-        --accent:#2563eb;
-        --warn:#d97706;
-        --error:#dc2626;
-        --card-bg:#ffffff;
-        --text:#111827;
-        --muted:#6b7280;
-        --border:#e5e7eb;
-      }
-      .app-title{font-weight:800;font-size:2rem;color:var(--primary);}
-      .pill{display:inline-block;padding:.2rem .6rem;border-radius:9999px;background:var(--primary);color:#fff;font-weight:700}
-      .card{background:var(--card-bg);border:1px solid var(--border);border-radius:14px;padding:16px;margin-bottom:12px;box-shadow:0 1px 3px rgba(0,0,0,0.06)}
-      .muted{color:var(--muted)}
-      .section-title{font-weight:800;border-left:4px solid var(--accent);padding-left:.5rem;margin:1rem 0 .5rem}
-      .tag{display:inline-block;border:1px solid var(--border);border-radius:10px;padding:.2rem .5rem;margin-right:.3rem}
-      .thinking{display:inline-block; font-weight:700}
-      .thinking::after{content:""; display:inline-block; width:1em; text-align:left; animation: dots 1.2s steps(4,end) infinite}
-      @keyframes dots{0%{content:""}25%{content:"."}50%{content:".."}75%{content:"..."}}
-      .ok{color:var(--primary);font-weight:700}
-      .warn{color:var(--warn);font-weight:700}
-      .error{color:var(--error);font-weight:700}
-      table.generated{width:100%; border-collapse:collapse}
-      table.generated th, table.generated td{border:1px solid var(--border); padding:.5rem; vertical-align:top}
-      table.generated th{background:rgba(37,99,235,0.08)}
-      .bubble-u{background:#eef7f7;border:1px solid var(--border);padding:.6rem .8rem;border-radius:14px}
-      .bubble-a{background:#f6f7ff;border:1px solid var(--border);padding:.6rem .8rem;border-radius:14px}
-      .small-muted{color:var(--muted); font-size:.85rem}
-      .chip{display:inline-block;background:rgba(14,165,164,0.1); color:#0ea5a4; border:1px solid #c7ecea; border-radius:999px; padding:.1rem .5rem; margin-left:.3rem}
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(BASE_STYLES, unsafe_allow_html=True)
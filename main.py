@@ -1,28 +1,43 @@
+import time
+from dotenv import load_dotenv
+
+# 各モジュールは import 時に設定（環境変数）を読むため、.env は他の import より先に反映する
+load_dotenv(override=False)
+
 import streamlit as st
-from initialize import get_client, load_env, inject_base_styles
+from initialize import get_client, get_inference, require_api_key, load_env, inject_base_styles
 from components import (
     app_header, disclaimer, patient_input_form, format_selector,
     output_section_soap, output_section_plan_table, followup_box,
-    end_session_box, show_toast, history_timeline
+    end_session_box, show_toast, history_timeline, live_plan_view, live_answer_view,
+    metrics_panel, retrieval_toggle, incremental_toggle
 )
-from inference import generate_care_plan, answer_followup
 from utils import (
-    ensure_session_state, is_relevant_question, save_last_outputs,
-    has_last_outputs, append_history_generation, append_history_followup
+    ensure_session_state, is_relevant_question, save_last_outputs, next_q_nonce,
+    has_last_outputs, append_history_generation, append_history_followup, is_admin, end_session
 )
+from worker_client import worker_url
+import metrics
+
+rerun_started = time.perf_counter()
+
+def rerun():
+    # st.rerun() は例外で抜けて末尾の計測に届かないため、ここまでの描画時間を先に記録する
+    metrics.observe_render("rerun", (time.perf_counter() - rerun_started) * 1000)
+    st.rerun()
 
 # --- Page setup ---
 st.set_page_config(page_title="看護計画アシスタント", page_icon="🩺", layout="wide")
 load_env()
 ensure_session_state()
-# フォローアップ入力欄のキー用ノンス（セッション内で増分）
-st.session_state.setdefault("q_nonce", 0)
+# 生成・フォローアップの呼び出し先（INFERENCE_WORKER_URL があれば推論ワーカー、なければこのプロセス）
+api = get_inference()
 
 # Inject styles（ライト固定・ダークモードなし）
 inject_base_styles()
 
-# --- Client ---
-client = get_client()
+# --- Client ---（openai SDK は初回の送信・質問時に読み込む）
+require_api_key()
 
 # --- Header & Disclaimer ---
 app_header()
@@ -31,7 +46,8 @@ disclaimer()
 # --- Conversation history (always visible) ---
 if st.session_state["history"]:
     st.markdown("## 🗂️ 会話履歴")
-    history_timeline(st.session_state["history"])
+    with metrics.timed_render("history_timeline"):
+        history_timeline(st.session_state["history"])
     st.markdown("---")
 
 # --- Input area ---
@@ -41,6 +57,8 @@ patient_text = patient_input_form()
 col1, col2 = st.columns([2, 1])
 with col1:
     output_format = format_selector()
+    use_retrieval = retrieval_toggle()
+    incremental = incremental_toggle() if has_last_outputs() else False
 with col2:
     submit = st.button("🚀 送信", use_container_width=True)
 
@@ -48,8 +66,14 @@ if submit:
     if not patient_text.strip():
         show_toast("看護情報を入力してください。", variant="warn")
     else:
+        # 確定したリスト要素から順に表示（ストリーミング）
         with st.spinner("思考中… 看護診断と計画を整理しています"):
-            result = generate_care_plan(client, patient_text, output_format)
+            result = api.generate_care_plan(
+                get_client(), patient_text, output_format,
+                on_partial=live_plan_view(output_format), use_retrieval=use_retrieval,
+                user=st.session_state["session_id"],
+                previous=st.session_state["last_outputs"] if incremental else None
+            )
         if result.get("error"):
             show_toast(result["error"], variant="error")
         else:
@@ -66,8 +90,8 @@ if submit:
             history_timeline([st.session_state["history"][-1]])
 
             # 次の質問入力欄が空から始まるように、キーを更新して再実行
-            st.session_state["q_nonce"] += 1
-            st.rerun()
+            next_q_nonce()
+            rerun()
 
 # --- Follow-up Q&A ---
 if has_last_outputs():
@@ -82,27 +106,43 @@ if has_last_outputs():
         if not q.strip():
             show_toast("質問内容を入力してください。", variant="warn")
         else:
-            if not is_relevant_question(q):
+            if not is_relevant_question(q, st.session_state["last_outputs"]):
                 st.info("本件とは関係がない質問です。対象：『看護情報 → 看護診断 / 看護計画（SOAP / 計画表）』に関するご質問を受け付けます。")
             else:
+                st.markdown("#### 回答")
                 with st.spinner("思考中… 回答を準備しています"):
-                    ans = answer_followup(
-                        client=client,
+                    ans = api.answer_followup(
+                        client=get_client(),
                         last_outputs=st.session_state["last_outputs"],
-                        question=q
+                        question=q,
+                        on_delta=live_answer_view(),
+                        user=st.session_state["session_id"]
                     )
                 if ans.get("error"):
                     show_toast(ans["error"], variant="error")
                 else:
-                    st.markdown("#### 回答")
-                    st.markdown(ans["answer"])
                     append_history_followup(question=q, answer=ans["answer"])
 
                     # 入力欄のキーを更新してから再実行（=テキストボックスがリセットされる）
-                    st.session_state["q_nonce"] += 1
-                    st.rerun()
+                    next_q_nonce()
+                    rerun()
 
 # --- End button ---
 st.markdown("---")
 if end_session_box():
+    end_session()
     st.success("お疲れさまでした")
+
+# --- Metrics（管理者のみ） ---
+metrics.observe_render("rerun", (time.perf_counter() - rerun_started) * 1000)
+if is_admin():
+    if worker_url():
+        stats = {"推論ワーカー": api.worker_stats(get_client()), "セッション履歴": st.session_state["history"].stats()}
+    else:
+        from inference import cache_stats, usage_stats, parse_stats
+        from concurrency import concurrency_stats
+        from initialize import get_pool_stats
+        stats = {"応答キャッシュ": cache_stats(), "トークン使用量": usage_stats(), "出力解析": parse_stats(), "接続プール": get_pool_stats(),
+                 "同時実行制御": concurrency_stats(), "セッション履歴": st.session_state["history"].stats(),
+                 "モデル別（振り分け）": metrics.summary(by="model")}
+    metrics_panel(metrics.summary(), stats, metrics.render_prometheus())
@@ -0,0 +1,211 @@
+"""
+推論呼び出しと描画のホットパス計測。
+
+- request_span(kind): 1リクエスト分の計測（queue / TTFT / total、トークン、再要求、キャッシュヒット）
+- observe_render(name, ms): 描画時間の記録
+- 記録は1行JSONのログ（logger "careplan.metrics"）として出力し、直近分をメモリに保持
+- summary() で p50/p95 集計、render_prometheus() で Prometheus テキスト形式
+  （CAREPLAN_METRICS_PROM_PATH 指定時はバックグラウンドで最大 CAREPLAN_METRICS_PROM_INTERVAL_SEC 秒ごとに
+   ファイルへ書き出し。textfile collector 用）
+"""
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+MAX_RECORDS = int(os.getenv("CAREPLAN_METRICS_MAX_RECORDS", "2000"))
+PROM_PATH = os.getenv("CAREPLAN_METRICS_PROM_PATH")
+PROM_INTERVAL_SEC = float(os.getenv("CAREPLAN_METRICS_PROM_INTERVAL_SEC", "5"))
+
+_records = deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+_current = contextvars.ContextVar("careplan_request_span", default=None)
+_prom_dirty = threading.Event()
+_prom_writer = None
+
+_log = logging.getLogger("careplan.metrics")
+if not _log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _log.addHandler(_handler)
+    _log.setLevel(logging.INFO)
+    _log.propagate = False
+
+class RequestSpan:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.t0 = time.perf_counter()
+        self.sent_at = None
+        self.first_token_at = None
+        self.fields = {
+            "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+            "api_calls": 0, "parse_retries": 0, "cache_hit": False,
+        }
+
+    def mark_sent(self):
+        with _lock:
+            self.fields["api_calls"] += 1
+            if self.sent_at is None:
+                self.sent_at = time.perf_counter()
+
+    def mark_first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def add(self, key: str, n: int = 1):
+        with _lock:
+            self.fields[key] = self.fields.get(key, 0) + n
+
+    def set(self, key: str, value):
+        self.fields[key] = value
+
+    def to_record(self, status: str, error_type: str = None) -> dict:
+        end = time.perf_counter()
+        sent = self.sent_at or end
+        rec = {
+            "type": "request",
+            "kind": self.kind,
+            "ts": time.time(),
+            "status": status,
+            "queue_ms": round((sent - self.t0) * 1000, 1),
+            "ttft_ms": round((self.first_token_at - self.t0) * 1000, 1) if self.first_token_at else None,
+            "total_ms": round((end - self.t0) * 1000, 1),
+            **self.fields,
+        }
+        if "cost_usd" in rec:
+            rec["cost_usd"] = round(rec["cost_usd"], 6)
+        if "limiter_wait_ms" in rec:
+            rec["limiter_wait_ms"] = round(rec["limiter_wait_ms"], 1)
+        if error_type:
+            rec["error_type"] = error_type
+        return rec
+
+@contextmanager
+def request_span(kind: str):
+    """with request_span("generation") as span: ...  例外は記録してから再送出する"""
+    span = RequestSpan(kind)
+    token = _current.set(span)
+    try:
+        yield span
+    except Exception as e:
+        _emit(span.to_record("error", type(e).__name__))
+        raise
+    else:
+        _emit(span.to_record(span.fields.pop("status", "ok")))
+    finally:
+        _current.reset(token)
+
+def current_span():
+    """現在のリクエストの計測（なければ None）。スレッドへは contextvars.copy_context() で引き継ぐ"""
+    return _current.get()
+
+def observe_render(name: str, ms: float):
+    _emit({"type": "render", "kind": name, "ts": time.time(), "total_ms": round(ms, 1)})
+
+@contextmanager
+def timed_render(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_render(name, (time.perf_counter() - t0) * 1000)
+
+def _emit(rec: dict):
+    with _lock:
+        _records.append(rec)
+    _log.info(json.dumps(rec, ensure_ascii=False))
+    if PROM_PATH:
+        _schedule_prometheus()
+
+def _schedule_prometheus():
+    # 集計・書き出しは記録元（スクリプトスレッド）では行わず、書き出し用スレッドにまとめる
+    global _prom_writer
+    _prom_dirty.set()
+    if _prom_writer is None:
+        with _lock:
+            if _prom_writer is None:
+                _prom_writer = threading.Thread(target=_prometheus_loop, name="careplan-metrics-prom", daemon=True)
+                _prom_writer.start()
+
+def _prometheus_loop():
+    while True:
+        _prom_dirty.wait()
+        _prom_dirty.clear()
+        _write_prometheus(PROM_PATH)
+        time.sleep(PROM_INTERVAL_SEC)
+
+# ===== aggregation / export =====
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def summary(by: str = None) -> dict:
+    """
+    type:kind ごとの件数・エラー数・p50/p95（total / TTFT / queue）とトークン・費用の累計。
+    by にレコードの項目名（"model" / "route" など）を渡すと type:kind:値 ごとに集計する
+    """
+    with _lock:
+        records = list(_records)
+    groups = defaultdict(list)
+    for rec in records:
+        name = f"{rec['type']}:{rec['kind']}"
+        if by:
+            if by not in rec:
+                continue
+            name = f"{name}:{rec[by]}"
+        groups[name].append(rec)
+    out = {}
+    for name, recs in sorted(groups.items()):
+        row = {"count": len(recs), "errors": sum(1 for r in recs if r.get("status") == "error")}
+        for field in ("total_ms", "ttft_ms", "queue_ms"):
+            vals = [r[field] for r in recs if r.get(field) is not None]
+            if vals:
+                row[f"{field}_p50"] = percentile(vals, 0.5)
+                row[f"{field}_p95"] = percentile(vals, 0.95)
+        for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "parse_retries", "api_calls"):
+            if any(field in r for r in recs):
+                row[field] = sum(r.get(field, 0) for r in recs)
+        if any("cost_usd" in r for r in recs):
+            row["cost_usd"] = round(sum(r.get("cost_usd", 0) for r in recs), 6)
+        if any("cache_hit" in r for r in recs):
+            row["cache_hits"] = sum(1 for r in recs if r.get("cache_hit"))
+        out[name] = row
+    return out
+
+def render_prometheus() -> str:
+    lines = []
+    for name, row in summary().items():
+        typ, kind = name.split(":", 1)
+        labels = f'type="{typ}",kind="{kind}"'
+        lines.append(f"careplan_events_total{{{labels}}} {row['count']}")
+        lines.append(f"careplan_errors_total{{{labels}}} {row['errors']}")
+        for field in ("total_ms", "ttft_ms", "queue_ms"):
+            for q in ("p50", "p95"):
+                if f"{field}_{q}" in row:
+                    quantile = "0.5" if q == "p50" else "0.95"
+                    lines.append(
+                        f'careplan_{field[:-3]}_seconds{{{labels},quantile="{quantile}"}} {row[f"{field}_{q}"] / 1000:.4f}'
+                    )
+        for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "parse_retries", "api_calls", "cache_hits", "cost_usd"):
+            if field in row:
+                lines.append(f"careplan_{field}_total{{{labels}}} {row[field]}")
+    return "\n".join(lines) + "\n"
+
+def _write_prometheus(path: str):
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+        os.replace(tmp, path)
+    except OSError as e:
+        _log.warning(json.dumps({"type": "metrics_error", "error": str(e)}))
+
+def reset():
+    with _lock:
+        _records.clear()
@@ -1,3 +1,6 @@
+import re
+import json
+
 SYSTEM_ROLE = """あなたは臨床現場での豊富な経験を持つベテランの看護師です。
 出力は日本語。対象は成人一般。NANDA-I/NIC/NOCに準拠した用語を用います。
 安全・再現性を重視し、臨床で実行可能な粒度で簡潔明瞭に記述します。
@@ -26,38 +29,268 @@ PLAN_JSON_SPEC = """
 リストは臨床的に妥当な件数（概ね3〜5）に調整してください。
 """
 
-def build_generation_prompt(patient_text: str, output_format: str) -> list:
-    user = f"""看護情報:
-\"\"\"{patient_text}\"\"\"
+def _spec_sections() -> dict:
+    # PLAN_JSON_SPEC 内のJSONひな形から セクション → キー一覧 を取り出す（スキーマの唯一の定義元）
+    skeleton = json.loads(PLAN_JSON_SPEC[PLAN_JSON_SPEC.index("{"):PLAN_JSON_SPEC.rindex("}") + 1])
+    return {section: list(fields) for section, fields in skeleton.items()}
+
+PLAN_SECTIONS = _spec_sections()
+
+# 出力形式ごとに中身が必須のセクション
+REQUIRED_SECTIONS = {
+    "SOAP形式": ["soap", "reasoning_summary"],
+    "看護計画表形式": ["plan_table", "reasoning_summary"],
+    "両方": ["soap", "plan_table", "reasoning_summary"],
+}
+
+def plan_json_schema(sections=None) -> dict:
+    """PLAN_JSON_SPEC 由来の strict JSON Schema（sections 指定時はそのセクションのみ）"""
+    sections = sections or list(PLAN_SECTIONS)
+    def str_list():
+        return {"type": "array", "items": {"type": "string"}}
+    return {
+        "type": "object",
+        "properties": {
+            sec: {
+                "type": "object",
+                "properties": {k: str_list() for k in PLAN_SECTIONS[sec]},
+                "required": list(PLAN_SECTIONS[sec]),
+                "additionalProperties": False,
+            }
+            for sec in sections
+        },
+        "required": list(sections),
+        "additionalProperties": False,
+    }
 
-要求:
-- 出力形式の希望: {output_format}
+def plan_response_format(sections=None) -> dict:
+    name = "care_plan" if not sections else "care_plan_" + "_".join(sections)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": plan_json_schema(sections)},
+    }
+
+# 静的な指示はすべて system 側に置き、バイト単位で不変な共通プレフィックスにする
+# （プロバイダ側のプロンプトキャッシュが一致するよう、可変部分＝看護情報・質問は末尾のユーザーメッセージへ）
+# ※ OpenAI のキャッシュ対象は 1024 トークン以上の共通プレフィックス。現状の静的部分（構造化出力のスキーマ込み）は
+#   生成で約850・フォローアップで約270トークンのため、この配置だけではキャッシュは効かない
+GENERATION_RULES = """要求:
+- 出力形式の希望（ユーザーメッセージで指定）に従う
 - SOAP形式では A（Assessment）と P（Plan）を列挙
 - 看護計画表形式では 問題/アセスメント/目標(NOC)/介入(NIC)/評価 を列挙
 - NANDA-I/NIC/NOC に準拠（用語/視点）
 - 重複や冗長表現を避ける
 - 実行可能性・安全性を明示（頻度、条件、観察ポイントなど）
+"""
+
+FOLLOWUP_RULES = """フォローアップ質問への回答ルール:
+- 回答はユーザーメッセージのコンテキスト（生成済み出力・JSON）に基づく説明・要約・意図の明確化に限定。
+- 生の思考連鎖の開示は禁止。代わりに reasoning_summary を根拠として説明。
+- 看護情報や出力と無関係な質問には答えない。
+- 箇条書きや短い段落で、臨床で使える形に簡潔化。
+"""
+
+GENERATION_SYSTEM = SYSTEM_ROLE + "\n\n" + GENERATION_RULES + PLAN_JSON_SPEC
+FOLLOWUP_SYSTEM = SYSTEM_ROLE + "\n\n" + FOLLOWUP_RULES
 
-{PLAN_JSON_SPEC}
+def build_generation_prompt(patient_text: str, output_format: str, example: dict = None) -> list:
+    user = f"""出力形式の希望: {output_format}
+
+看護情報:
+\"\"\"{patient_text}\"\"\"
 """
+    if example:
+        user += build_example_block(example)
     return [
-        {"role":"system", "content": SYSTEM_ROLE},
+        {"role":"system", "content": GENERATION_SYSTEM},
         {"role":"user", "content": user}
     ]
 
-def build_followup_prompt(context: dict, question: str) -> list:
-    user = f"""コンテキスト（生成済み出力）:
+def number_plan_items(plan: dict) -> dict:
+    # 各項目に "[番号]" を付ける（モデルが "#番号" で参照できるように）
+    return {
+        sec: {k: [f"[{i}] {x}" for i, x in enumerate(items or [], start=1)] for k, items in (fields or {}).items()}
+        for sec, fields in plan.items() if fields
+    }
+
+def build_example_block(example: dict) -> str:
+    """類似症例の既存計画を参考例として添える。同じでよい項目は "#番号" 参照で短く書かせる"""
+    return f"""
+参考例（類似症例で作成済みの計画。入力は匿名化・抜粋）:
+入力: \"\"\"{example["text"]}\"\"\"
+計画: {dump_context(number_plan_items(example["plan"]))}
+参考例と同じ内容でよい項目は、同じキーの項目番号を "#番号"（例: "#2"）とだけ書いてください。
+今回の看護情報に合わせて変える・追加する項目のみ文章で記述してください。
+"""
+
+def build_patch_prompt(patient_text: str, output_format: str, previous_plan: dict, diff: dict) -> list:
+    """
+    前回の計画に対する差分更新の依頼（diff は utils.diff_patient_text の結果）。
+    変更に関係しない項目は "#番号" 参照で返させ、影響する問題・行と SOAP の項目だけを書き直させる
+    """
+    messages = build_generation_prompt(patient_text, output_format)
+    added = "\n".join(f"- {x}" for x in diff["added"]) or "（なし）"
+    removed = "\n".join(f"- {x}" for x in diff["removed"]) or "（なし）"
+    messages[-1]["content"] += f"""
+前回の計画（前回の看護情報から作成済み）:
+{dump_context(number_plan_items(previous_plan))}
+
+前回から変わった看護情報:
+追加・変更後:
+{added}
+削除・変更前:
+{removed}
+
+変更に関係しない項目は、前回の同じキーの項目番号を "#番号"（例: "#2"）とだけ書き、順序も前回どおりにしてください。
+変更によって見直しが必要な問題（plan_table の行）と、関連する SOAP・根拠の項目だけを文章で書き直してください。
+新たな問題は末尾に追加し、不要になった項目は省いてください。plan_table の各キーは同じ位置の項目どうしが1つの問題（行）です。
+"""
+    return messages
+
+def build_section_prompt(patient_text: str, output_format: str, sections: list, example: dict = None) -> list:
+    # 指定セクションだけを要求する（並列生成・失敗セクションの再要求用。プレフィックスは生成時と共通）
+    messages = build_generation_prompt(patient_text, output_format, example)
+    shape = ", ".join(
+        f'"{sec}": {{' + ", ".join(f'"{k}": [...]' for k in PLAN_SECTIONS[sec]) + "}" for sec in sections
+    )
+    names = "・".join(f'"{sec}"' for sec in sections)
+    messages[-1]["content"] += f"""
+今回は {names} セクションのみを、上記JSON仕様の該当部分の形で返してください:
+{{{shape}}}
+"""
+    return messages
+
+def build_followup_prompt(context, question: str) -> list:
+    if not isinstance(context, str):
+        context = dump_context(context)
+    user = f"""コンテキスト（生成済み出力・JSON）:
 {context}
 
 質問: {question}
-
-制約:
-- 回答は上記コンテキストに基づく説明・要約・意図の明確化に限定。
-- 生の思考連鎖の開示は禁止。代わりに reasoning_summary を根拠として説明。
-- 看護情報や出力と無関係な質問には答えない。
-- 箇条書きや短い段落で、臨床で使える形に簡潔化。
 """
     return [
-        {"role":"system", "content": SYSTEM_ROLE},
+        {"role":"system", "content": FOLLOWUP_SYSTEM},
         {"role":"user", "content": user}
     ]
+
+# ===== Follow-up context selection =====
+FOLLOWUP_CONTEXT_MAX_TOKENS = 1200
+
+PLAN_TABLE_KEYS = PLAN_SECTIONS["plan_table"]
+
+# 質問中の語 → 関連するセクション
+SECTION_KEYWORDS = {
+    "plan_table.problems": ["問題", "診断", "NANDA", "ラベル", "関連因子", "定義"],
+    "plan_table.assessments": ["アセスメント", "根拠", "観察", "測定"],
+    "plan_table.goals": ["目標", "NOC", "ゴール", "短期", "長期", "指標", "成果"],
+    "plan_table.interventions": ["介入", "NIC", "ケア", "援助", "頻度", "タイミング", "実施", "指導"],
+    "plan_table.evaluation": ["評価", "再評価", "判定", "基準", "次の一手"],
+    "soap": ["SOAP", "A（", "P（", "Assessment", "Plan", "プラン"],
+    "reasoning_summary": ["根拠", "理由", "なぜ", "意図", "推論", "所見", "鑑別"],
+    "patient_text": ["入力", "患者情報", "バイタル", "検査", "既往", "主訴", "ADL", "原文"],
+}
+
+def estimate_tokens(text: str) -> int:
+    """ローカルでのトークン数見積り（tiktoken があれば使用、なければ文字種ごとの近似）"""
+    enc = _get_encoder()
+    if enc is not None:
+        return len(enc.encode(text))
+    # 近似: CJK は概ね1文字≒1トークン、ASCII は4文字≒1トークン
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+_encoder = False
+
+def _get_encoder():
+    global _encoder
+    if _encoder is False:
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoder = None
+    return _encoder
+
+def dump_context(context: dict) -> str:
+    return json.dumps(context, ensure_ascii=False, separators=(",", ":"))
+
+def select_followup_context(last_outputs: dict, question: str, max_tokens: int = FOLLOWUP_CONTEXT_MAX_TOKENS):
+    """
+    質問に関係するセクションだけを抜き出し、トークン上限内のコンパクトなJSONにする。
+    返り値: (context_json, stats)  stats は full_tokens / context_tokens / saved_tokens / sections
+    """
+    full = {k: last_outputs.get(k) for k in ("patient_text", "soap", "plan_table", "reasoning_summary")}
+    wanted = {name for name, words in SECTION_KEYWORDS.items() if any(w.lower() in question.lower() for w in words)}
+
+    context = {}
+    table_keys = [k for k in PLAN_TABLE_KEYS if f"plan_table.{k}" in wanted]
+    plan_table = full.get("plan_table") or {}
+    if table_keys:
+        # 列を選んだ場合は対応する看護問題も添える（行は質問と語が重なるものに絞る）
+        keys = ["problems"] + [k for k in table_keys if k != "problems"]
+        rows = _matching_rows(plan_table, question)
+        context["plan_table"] = {k: [_at(plan_table, k, i) for i in rows] for k in keys}
+    if "soap" in wanted:
+        context["soap"] = full.get("soap")
+    if "reasoning_summary" in wanted:
+        context["reasoning_summary"] = full.get("reasoning_summary")
+    if "patient_text" in wanted or not context:
+        # 入力原文は明示的に問われた場合か、セクションを特定できない場合のみ（予算超過時は先に削る）
+        context = {"patient_text": full.get("patient_text") or "", **context}
+    if list(context) == ["patient_text"] and "patient_text" not in wanted:
+        context.update({k: full[k] for k in ("soap", "plan_table", "reasoning_summary")})
+
+    context, text = _fit_budget(context, max_tokens, keep_patient_text="patient_text" in wanted)
+    # 従来の repr による全量埋め込みとの比較
+    full_tokens = estimate_tokens(str(full))
+    context_tokens = estimate_tokens(text)
+    return text, {
+        "full_tokens": full_tokens,
+        "context_tokens": context_tokens,
+        "saved_tokens": max(0, full_tokens - context_tokens),
+        "sections": list(context),
+    }
+
+def _at(plan_table: dict, key: str, idx: int) -> str:
+    arr = plan_table.get(key) or []
+    return arr[idx] if idx < len(arr) else ""
+
+def _matching_rows(plan_table: dict, question: str) -> list:
+    n = max((len(plan_table.get(k) or []) for k in PLAN_TABLE_KEYS), default=0)
+    q_grams = _bigrams(question)
+    scores = []
+    for i in range(n):
+        row = " ".join(_at(plan_table, k, i) for k in PLAN_TABLE_KEYS)
+        scores.append(len(q_grams & _bigrams(row)))
+    best = max(scores, default=0)
+    if best < 2:
+        return list(range(n))
+    return [i for i, s in enumerate(scores) if s >= best / 2]
+
+def _bigrams(text: str) -> set:
+    # 記号・空白と汎用語を除いた文字2-gram
+    text = re.sub(r"[\s\W]+", "", text or "")
+    for w in ("看護", "患者", "について", "教えて", "ください"):
+        text = text.replace(w, "")
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _fit_budget(context: dict, max_tokens: int, keep_patient_text: bool) -> tuple:
+    """(削った後の context, その JSON 文字列) を返す"""
+    text = dump_context(context)
+    if estimate_tokens(text) <= max_tokens:
+        return context, text
+    # 優先度の低いものから削る: 入力原文 → 推論要約 → SOAP（計画表は最後まで残す）
+    for key in ("patient_text", "reasoning_summary", "soap"):
+        if key not in context or (key == "patient_text" and keep_patient_text):
+            continue
+        context = {k: v for k, v in context.items() if k != key}
+        text = dump_context(context)
+        if estimate_tokens(text) <= max_tokens:
+            return context, text
+    # それでも超える場合は原文を末尾から切り詰める
+    if context.get("patient_text"):
+        over = estimate_tokens(text) - max_tokens
+        pt = context["patient_text"]
+        context["patient_text"] = pt[:max(0, len(pt) - over)] + "…"
+        text = dump_context(context)
+    return context, text
@@ -0,0 +1,185 @@
+"""
+フォローアップ質問の関連性判定（ローカル・CPUのみ）。
+
+1. キーワード段: 重み付き語彙を Aho–Corasick オートマトンに一度だけコンパイルし、質問を1パスで走査
+2. 重なり段: 質問の漢字2-gram・かな3-gram が直近の看護情報・生成結果に現れるか（「体動時」「医師」など）
+3. ベクトル段: 質問と直近の生成結果（last_outputs の各項目）の n-gram ハッシュベクトルの最大類似度
+
+臨床語があれば通過、無関係語だけなら遮断、どちらでもなければ生成結果との重なり・類似度で判定します。
+語彙としきい値は benchmarks/relevance_labels.jsonl・relevance_tuning.jsonl で調整し、
+benchmarks/relevance_heldout.jsonl（調整には使わない質問）で確認しています。
+"""
+import re
+import unicodedata
+from collections import OrderedDict, deque
+import numpy as np
+from retrieval import embed
+
+# 重み 1.0: 看護計画・臨床の語（単独で関連ありと判定）
+CLINICAL_KEYWORDS = [
+    "看護", "診断", "目標", "介入", "看護計画", "評価日", "アセスメント", "SOAP", "根拠",
+    "NANDA", "NANDA-I", "NIC", "NOC", "観察", "ケア", "援助", "指導", "頻度", "優先",
+    "体位変換", "離床", "転倒", "褥瘡", "疼痛", "鎮痛", "バイタル", "血圧", "脈拍", "体温", "呼吸", "SpO2",
+    "酸素", "嚥下", "誤嚥", "食事", "栄養", "水分", "排泄", "排尿", "排便", "浮腫", "体重", "感染", "発熱",
+    "せん妄", "不穏", "睡眠", "清潔", "口腔", "創部", "ドレーン", "点滴", "内服", "服薬", "退院", "家族",
+    "リハ", "ADL", "NRS", "術後", "骨折", "脱臼", "ふらつき", "検査", "所見", "鑑別", "短期", "長期", "再評価", "S情報", "O情報",
+    # 症状
+    "痛み", "しびれ", "痒み", "かゆみ", "吐き気", "嘔吐", "めまい", "息切れ", "咳嗽", "出血", "腫脹", "発赤",
+    "倦怠感", "眠れ", "不眠", "血栓", "心拍",
+    # 処置・身体
+    "傷口", "創傷", "手術", "麻酔", "抜糸", "カテーテル", "罨法", "清拭", "入浴", "シャワー", "安静",
+    # 移動・介助
+    "歩行", "車椅子", "移乗", "起き上が", "立ち上が", "介助", "姿勢", "体位",
+    # 薬
+    "薬剤", "与薬", "痛み止め", "頓用", "頓服", "投与", "副作用",
+    # 連携・勤務
+    "医師", "主治医", "報告", "申し送り", "夜勤", "日勤", "多職種", "理学療法", "声かけ",
+    # 生活・背景
+    "トイレ", "自宅", "在宅", "高齢", "認知",
+    # 生成結果の項目を指す表現
+    "項目", "番目", "言い換え", "箇条書き",
+]
+# 重み 0.3: それだけでは判断できない語（生成結果との類似度と組み合わせる）
+WEAK_KEYWORDS = [
+    "患者", "要点", "説明", "要約", "意図", "なぜ", "理由", "どうして", "どういう", "意味",
+    "対応", "対処", "気をつけ", "注意", "生活", "まとめ", "評価", "計画",
+    # 1文字の語は「独創」「文脈」「薬局」などの一般語にも含まれるため単独では通さない
+    "咳", "痰", "脈", "傷", "創", "杖", "薬",
+]
+# 重み -1.0: 明らかに無関係な話題
+OFFTOPIC_KEYWORDS = [
+    "天気", "株価", "株", "為替", "レシピ", "料理", "映画", "ドラマ", "アニメ", "ゲーム", "野球", "サッカー",
+    "旅行", "観光", "ホテル", "プログラミング", "python", "javascript", "恋愛", "占い", "宝くじ", "競馬",
+    "ニュース", "選挙", "政治", "歌", "音楽", "ファッション", "給料", "転職", "雑談", "営業",
+]
+
+SIM_THRESHOLD = 0.35        # キーワードなしでも通す類似度
+WEAK_SIM_THRESHOLD = 0.2    # 弱い語があるときの類似度
+_CONTEXT_MEMO_MAX = 64
+_KANJI_BIGRAM = re.compile(r"^[一-龥々]{2}$")
+_KANA_TRIGRAM = re.compile(r"^[ぁ-ゖァ-ヺー]{3}$")
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+class KeywordAutomaton:
+    """Aho–Corasick: 全キーワードを1回の走査で検出し、重みを返す"""
+    def __init__(self, weighted: dict):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for word, weight in weighted.items():
+            self._insert(_normalize(word), weight)
+        self._build()
+
+    def _insert(self, word: str, weight: float):
+        node = 0
+        for ch in word:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        self.out[node].append((word, weight))
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text: str) -> dict:
+        """検出した語 → 重み"""
+        found = {}
+        node = 0
+        for ch in _normalize(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for word, weight in self.out[node]:
+                found[word] = weight
+        return found
+
+# SOAP の A / P は1文字だと誤検出が多いため、項目を指す表記でのみ拾う
+_SOAP_LETTER_FORMS = {"Aの": 1.0, "Pの": 1.0, "A（": 1.0, "P（": 1.0, "A(": 1.0, "P(": 1.0}
+
+def _weights() -> dict:
+    weights = {w: 1.0 for w in CLINICAL_KEYWORDS}
+    weights.update(_SOAP_LETTER_FORMS)
+    weights.update({w: 0.3 for w in WEAK_KEYWORDS})
+    weights.update({w: -1.0 for w in OFFTOPIC_KEYWORDS})
+    return weights
+
+_automaton = KeywordAutomaton(_weights())
+_context_memo = OrderedDict()   # (id(last_outputs), patient_text) -> (項目ベクトル行列, 内容語 n-gram 集合)
+
+def _content_grams(text: str) -> set:
+    # 助詞などを含まない漢字2-gram・かな3-gram（「定を」「ント」のような偶然の一致を拾わない）
+    grams = set()
+    for word in re.split(r"[\W_]+", _normalize(text)):
+        grams.update(g for g in (word[i:i + 2] for i in range(len(word) - 1)) if _KANJI_BIGRAM.match(g))
+        grams.update(g for g in (word[i:i + 3] for i in range(len(word) - 2)) if _KANA_TRIGRAM.match(g))
+    return grams
+
+def _context(last_outputs: dict):
+    key = (id(last_outputs), last_outputs.get("patient_text"))
+    found = _context_memo.get(key)
+    if found is not None:
+        _context_memo.move_to_end(key)
+        return found
+    texts = [last_outputs.get("patient_text") or ""]
+    for section in ("soap", "plan_table", "reasoning_summary"):
+        for items in (last_outputs.get(section) or {}).values():
+            texts.extend(x for x in items or [] if isinstance(x, str))
+    matrix = np.vstack([embed(t) for t in texts if t]) if any(texts) else np.zeros((0, 1), dtype=np.float32)
+    found = (matrix, set().union(*(_content_grams(t) for t in texts)))
+    _context_memo[key] = found
+    if len(_context_memo) > _CONTEXT_MEMO_MAX:
+        _context_memo.popitem(last=False)
+    return found
+
+def context_similarity(question: str, last_outputs: dict) -> float:
+    if not last_outputs:
+        return 0.0
+    matrix = _context(last_outputs)[0]
+    if matrix.shape[0] == 0:
+        return 0.0
+    return float((matrix @ embed(question)).max())
+
+def context_overlap(question: str, last_outputs: dict) -> list:
+    """質問の内容語 n-gram のうち、直近の看護情報・生成結果に現れるもの"""
+    if not last_outputs:
+        return []
+    return sorted(_content_grams(question) & _context(last_outputs)[1])
+
+def classify(question: str, last_outputs: dict = None) -> dict:
+    """判定の内訳（relevant / keywords / similarity / stage）"""
+    q = (question or "").strip()
+    if not q:
+        return {"relevant": False, "keywords": {}, "similarity": 0.0, "stage": "empty"}
+    hits = _automaton.find(q)
+    strong = any(w >= 1.0 for w in hits.values())
+    offtopic = any(w < 0 for w in hits.values())
+    if strong and not offtopic:
+        return {"relevant": True, "keywords": hits, "similarity": None, "stage": "keyword"}
+    if offtopic and not strong:
+        return {"relevant": False, "keywords": hits, "similarity": None, "stage": "offtopic"}
+    # 語彙で拾った語（「評価」「計画」など生成結果にほぼ必ず現れる弱い語）は重なりの根拠にしない
+    overlap = [g for g in context_overlap(q, last_outputs) if g not in hits]
+    if overlap and not offtopic:
+        return {"relevant": True, "keywords": hits, "overlap": overlap, "similarity": None, "stage": "overlap"}
+    sim = context_similarity(q, last_outputs)
+    threshold = WEAK_SIM_THRESHOLD if (strong or any(w > 0 for w in hits.values())) else SIM_THRESHOLD
+    return {"relevant": sim >= threshold, "keywords": hits, "similarity": round(sim, 3), "stage": "vector"}
+
+def is_relevant(question: str, last_outputs: dict = None) -> bool:
+    return classify(question, last_outputs)["relevant"]
@@ -0,0 +1,166 @@
+"""
+過去に生成した看護計画の類似検索（プロセス内・オフライン）。
+
+- 入力文と計画の各項目は anonymize() で氏名・住所・ID・日付・電話番号などを伏せてから索引化
+  （計画は他のセッションの下書き・参考例としてそのまま使われるため）
+- 埋め込みは文字 n-gram（1〜3）のハッシュベクトル（外部モデル不要・CPUのみ）
+- 近傍探索は正規化済み行列と質問ベクトルの内積（NumPy）で一括計算
+- CAREPLAN_RETRIEVAL_PATH 指定時は SQLite に保存し、再起動後・セッション間で共有
+"""
+import os
+import re
+import json
+import zlib
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+import numpy as np
+
+EMBED_DIM = 1024
+NGRAM_SIZES = (1, 2, 3)
+MAX_ENTRIES = int(os.getenv("CAREPLAN_RETRIEVAL_MAX", "5000"))
+# 類似度のしきい値: これ以上なら生成中に過去計画を仮の下書きとして表示 / 参考例として提示
+DRAFT_THRESHOLD = float(os.getenv("CAREPLAN_RETRIEVAL_DRAFT", "0.95"))
+EXAMPLE_THRESHOLD = float(os.getenv("CAREPLAN_RETRIEVAL_EXAMPLE", "0.6"))
+EXAMPLE_TEXT_CHARS = 300
+
+_ANON_PATTERNS = [
+    # 「氏名: 山田 太郎」「住所 東京都…」のようなラベル付きの値は区切り（、。改行）まで伏せる
+    (re.compile(r"(患者氏名|氏名|名前|患者名|住所|生年月日|緊急連絡先|連絡先)(?:\s*[:：]\s*|\s+)[^、。,，\n]+"), "\\1:＊"),
+    (re.compile(r"(?:東京都|北海道|京都府|大阪府|[一-龥]{2,3}県)[一-龥ぁ-んァ-ヶ0-9０-９\-－ー]+"), "＊住所＊"),
+    # 「田中花子（80）」のように氏名の直後に年齢を括弧書きしたもの
+    (re.compile(r"[一-龥ァ-ヶ]{2,8}(?=[（(]\d{1,3}歳?[）)])"), "〇〇"),
+    (re.compile(r"[一-龥ぁ-んァ-ヶA-Za-z]{1,10}(さん|様|氏|くん|ちゃん)"), "〇〇\\1"),
+    (re.compile(r"(ID|ＩＤ|患者番号|カルテ番号|No\.?)\s*[:：]?\s*[0-9A-Za-z\-]+"), "\\1:＊"),
+    (re.compile(r"\d{4}[/\-年]\d{1,2}[/\-月]\d{1,2}日?"), "＊年＊月＊日"),
+    (re.compile(r"\d{1,2}月\d{1,2}日"), "＊月＊日"),
+    (re.compile(r"0\d{1,4}-\d{1,4}-\d{3,4}"), "＊電話番号＊"),
+]
+
+def anonymize(text: str) -> str:
+    """索引に載せる前に個人を特定しうる表記を伏せる（年齢・検査値など臨床情報は残す）"""
+    for pattern, repl in _ANON_PATTERNS:
+        text = pattern.sub(repl, text or "")
+    return text
+
+def anonymize_plan(value):
+    """計画（dict / list / 文字列の入れ子）の文字列をすべて anonymize() する"""
+    if isinstance(value, str):
+        return anonymize(value)
+    if isinstance(value, dict):
+        return {k: anonymize_plan(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize_plan(v) for v in value]
+    return value
+
+def embed(text: str) -> np.ndarray:
+    """文字 n-gram のハッシュ埋め込み（L2 正規化、float32）"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    idx = [
+        zlib.crc32(text[i:i + n].encode("utf-8")) % EMBED_DIM
+        for n in NGRAM_SIZES for i in range(len(text) - n + 1)
+    ]
+    vec = np.bincount(np.asarray(idx, dtype=np.int64), minlength=EMBED_DIM).astype(np.float32)
+    np.log1p(vec, out=vec)   # 頻出 n-gram の影響を抑える
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+class PlanIndex:
+    def __init__(self, path: str = None, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._matrix = np.zeros((0, EMBED_DIM), dtype=np.float32)
+        self._items = []      # {"text", "output_format", "plan"}
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, patient_text: str, output_format: str, plan: dict):
+        text = anonymize(patient_text)
+        item = {
+            "text": text[:EXAMPLE_TEXT_CHARS],
+            "output_format": output_format,
+            "plan": {k: anonymize_plan(plan.get(k)) for k in ("soap", "plan_table", "reasoning_summary")},
+        }
+        vec = embed(text)
+        with self._lock:
+            self._matrix = np.vstack([self._matrix, vec[None, :]])[-self.max_entries:]
+            self._items = (self._items + [item])[-self.max_entries:]
+        if self.path:
+            self._save(vec, item)
+
+    def search(self, patient_text: str, output_format: str = None, k: int = 1) -> list:
+        """(similarity, item) を類似度の高い順に最大 k 件。output_format 指定時は同じ形式のみ"""
+        with self._lock:
+            matrix, items = self._matrix, self._items
+        if not items:
+            return []
+        sims = matrix @ embed(anonymize(patient_text))
+        if output_format:
+            mask = np.fromiter((it["output_format"] == output_format for it in items), dtype=bool, count=len(items))
+            sims = np.where(mask, sims, -1.0)
+        top = np.argsort(-sims)[:k]
+        return [(float(sims[i]), items[i]) for i in top if sims[i] >= 0]
+
+    @contextmanager
+    def _connect(self):
+        # 1操作ごとに開いて必ず閉じる（sqlite3 の with は commit / rollback のみで close しない）
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _load(self):
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS plan_index(id INTEGER PRIMARY KEY, vec BLOB, item TEXT)")
+            rows = conn.execute(
+                "SELECT vec, item FROM plan_index ORDER BY id DESC LIMIT ?", (self.max_entries,)
+            ).fetchall()[::-1]
+        if rows:
+            self._matrix = np.vstack([np.frombuffer(v, dtype=np.float32) for v, _ in rows])
+            # 匿名化の規則を追加する前に保存された分もここで伏せる
+            self._items = [
+                {**item, "text": anonymize(item.get("text")), "plan": anonymize_plan(item.get("plan"))}
+                for item in map(json.loads, (it for _, it in rows))
+            ]
+
+    def _save(self, vec: np.ndarray, item: dict):
+        with self._connect() as conn:
+            conn.execute("INSERT INTO plan_index(vec, item) VALUES(?,?)",
+                         (vec.astype(np.float32).tobytes(), json.dumps(item, ensure_ascii=False)))
+            conn.execute("DELETE FROM plan_index WHERE id <= (SELECT MAX(id) FROM plan_index) - ?", (self.max_entries,))
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index() -> PlanIndex:
+    """プロセス共有の索引（CAREPLAN_RETRIEVAL=0 なら None）"""
+    global _index
+    if os.getenv("CAREPLAN_RETRIEVAL", "1") == "0":
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = PlanIndex(os.getenv("CAREPLAN_RETRIEVAL_PATH"))
+    return _index
+
+def find_similar(patient_text: str, output_format: str):
+    """最も近い過去計画を (similarity, item) で返す。EXAMPLE_THRESHOLD 未満なら None"""
+    index = get_index()
+    if index is None:
+        return None
+    found = index.search(patient_text, output_format, k=1)
+    if not found or found[0][0] < EXAMPLE_THRESHOLD:
+        return None
+    return found[0]
+
+def index_plan(patient_text: str, output_format: str, plan: dict):
+    index = get_index()
+    if index is not None:
+        index.add(patient_text, output_format, plan)
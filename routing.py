@@ -0,0 +1,76 @@
+"""
+リクエストごとのモデル選択。
+
+- フォローアップ: 短い質問は安価で速いモデル（FAST）、長い質問は上位モデル（STRONG）
+- 看護計画の生成: 入力が長い・複数の問題（#1 / ①・既往・合併 など）を含む場合は STRONG、それ以外は FAST
+- 投機モード（CAREPLAN_SPECULATIVE=1）: STRONG に振り分けた生成でも FAST の下書きを先に表示し、
+  STRONG の完成結果で置き換える
+
+判断内容（model / route）とトークン数から見積もった費用（cost_usd）は request_span に記録され、
+metrics の1行JSONログと metrics.summary(by="model") でレイテンシと並べて確認できます。
+"""
+import os
+import re
+import json
+from dataclasses import dataclass
+from prompts import estimate_tokens
+
+FAST_MODEL = os.getenv("CAREPLAN_FAST_MODEL", "gpt-4o-mini")
+STRONG_MODEL = os.getenv("CAREPLAN_STRONG_MODEL", "gpt-4o")
+# "0" で振り分けを止め、すべて FAST_MODEL で処理する
+ROUTING = os.getenv("CAREPLAN_ROUTING", "1") != "0"
+SPECULATIVE = os.getenv("CAREPLAN_SPECULATIVE", "0") == "1"
+LONG_INPUT_TOKENS = int(os.getenv("CAREPLAN_ROUTING_LONG_TOKENS", "600"))
+MULTI_PROBLEM_MIN = int(os.getenv("CAREPLAN_ROUTING_MULTI_PROBLEMS", "3"))
+LONG_QUESTION_TOKENS = int(os.getenv("CAREPLAN_ROUTING_LONG_QUESTION_TOKENS", "150"))
+
+# USD / 100万トークン（入力, キャッシュ済み入力, 出力）。CAREPLAN_MODEL_PRICES（JSON）で上書き可
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv("CAREPLAN_MODEL_PRICES", "{}")).items()})
+
+_PROBLEM_MARKERS = re.compile(r"[#＃]\s*\d|[①-⑳]|既往|合併|併存")
+
+@dataclass(frozen=True, slots=True)
+class Route:
+    model: str
+    tier: str       # "fast" | "strong"
+    reason: str     # 振り分けの理由（ログ・集計用）
+
+    @property
+    def speculative(self) -> bool:
+        """FAST の下書きを先に表示するか"""
+        return SPECULATIVE and self.tier == "strong" and self.model != FAST_MODEL
+
+def fast_route(reason: str = "fast") -> Route:
+    return Route(FAST_MODEL, "fast", reason)
+
+def count_problems(text: str) -> int:
+    return len(_PROBLEM_MARKERS.findall(text or ""))
+
+def route(kind: str, text: str) -> Route:
+    """kind: "generation"（text=患者情報）| "followup"（text=質問）"""
+    if not ROUTING:
+        return fast_route("routing_off")
+    tokens = estimate_tokens(text or "")
+    if kind == "followup":
+        if tokens >= LONG_QUESTION_TOKENS:
+            return Route(STRONG_MODEL, "strong", "long_question")
+        return fast_route("short_question")
+    if tokens >= LONG_INPUT_TOKENS:
+        return Route(STRONG_MODEL, "strong", "long_input")
+    if count_problems(text) >= MULTI_PROBLEM_MIN:
+        return Route(STRONG_MODEL, "strong", "multi_problem")
+    return fast_route("short_input")
+
+def cost_usd(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """usage からの費用見積もり（単価が未登録のモデルは 0）"""
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        return 0.0
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (uncached * price[0] + cached_tokens * price[1] + completion_tokens * price[2]) / 1_000_000
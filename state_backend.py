@@ -0,0 +1,241 @@
+"""
+セッション状態（last_outputs・会話履歴・入力欄ノンス）の外部保存。
+
+Streamlit のプロセス外に保存しておくと、再起動後や別レプリカへ振り分けられた後も、
+URL の ?sid=<セッションID> から同じセッションを復元できます。保存内容には看護情報の原文が含まれるため、
+復元は保存時と同じ接続元のブラウザに限ります（utils._client_fingerprint。URL を共有しても他の人には復元されない）。
+
+  CAREPLAN_STATE_BACKEND   "session"（既定。st.session_state のみ） | "sqlite" | "redis"
+  CAREPLAN_STATE_PATH      sqlite の保存先ファイル
+  CAREPLAN_REDIS_URL       redis://[:password@]host:port/db（Redis プロトコル互換のサーバ）
+  CAREPLAN_STATE_TTL_SEC   保持期間（既定 24 時間）
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+DEFAULT_TTL_SEC = 24 * 60 * 60   # 1日（夜勤をまたいでも残る程度）
+DEFAULT_SQLITE_PATH = os.path.join(tempfile.gettempdir(), "careplan_state.sqlite")
+
+class SQLiteStateBackend:
+    """ローカルファイル（同一ホスト上の複数プロセスで共有可）"""
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, ttl_sec: float = DEFAULT_TTL_SEC):
+        self.path = path
+        self.ttl_sec = ttl_sec
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_kv("
+                "session_id TEXT, key TEXT, value TEXT, updated REAL, PRIMARY KEY(session_id, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_history("
+                "id INTEGER PRIMARY KEY, session_id TEXT, type TEXT, ts TEXT, payload TEXT, created REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS session_history_sid ON session_history(session_id, id)")
+            conn.execute("DELETE FROM session_kv WHERE updated < ?", (time.time() - ttl_sec,))
+            conn.execute("DELETE FROM session_history WHERE created < ?", (time.time() - ttl_sec,))
+
+    def get(self, session_id: str, key: str):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM session_kv WHERE session_id=? AND key=? AND updated >= ?",
+                (session_id, key, time.time() - self.ttl_sec)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_id: str, key: str, value):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO session_kv(session_id, key, value, updated) VALUES(?,?,?,?)",
+                (session_id, key, json.dumps(value, ensure_ascii=False), time.time())
+            )
+
+    def append_history(self, session_id: str, type: str, ts: str, payload: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO session_history(session_id, type, ts, payload, created) VALUES(?,?,?,?,?)",
+                (session_id, type, ts, json.dumps(payload, ensure_ascii=False), time.time())
+            )
+
+    def load_history(self, session_id: str) -> list:
+        """[(type, ts, payload), ...]（古い順）"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT type, ts, payload FROM session_history WHERE session_id=? AND created >= ? ORDER BY id",
+                (session_id, time.time() - self.ttl_sec)
+            ).fetchall()
+        return [(t, ts, json.loads(p)) for t, ts, p in rows]
+
+    def discard(self, session_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM session_kv WHERE session_id=?", (session_id,))
+            conn.execute("DELETE FROM session_history WHERE session_id=?", (session_id,))
+
+    @contextmanager
+    def _connect(self):
+        # 1操作ごとに開いて必ず閉じる（sqlite3 の with は commit / rollback のみで close しない）
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+class RespError(Exception):
+    pass
+
+# 接続が切れて応答を受け取れなかったときに再送してよいコマンド
+_IDEMPOTENT_COMMANDS = {"GET", "SET", "DEL", "EXPIRE", "LRANGE", "PING"}
+
+class RespClient:
+    """Redis プロトコル（RESP2）の最小クライアント（追加の依存なし・接続は1本をロックで共有）"""
+    def __init__(self, url: str, timeout: float = 5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def execute(self, *args):
+        retry_after_send = str(args[0]).upper() in _IDEMPOTENT_COMMANDS
+        with self._lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self._sock is None or self._peer_closed():
+                        self._close()
+                        self._connect()
+                    self._send(args)
+                    sent = True
+                    return self._read()
+                except (OSError, EOFError):
+                    # 切断されていたら1回だけ接続し直す。送信後の失敗はサーバ側で実行済みのことがあるため、
+                    # 再送しても結果が変わらないコマンドに限る（RPUSH を再送すると履歴が重複する）
+                    self._close()
+                    if attempt or (sent and not retry_after_send):
+                        raise
+
+    def _peer_closed(self) -> bool:
+        # アイドル中にサーバ側から閉じられた接続は送信前に検出して張り直す（送信後の失敗を減らす）
+        try:
+            self._sock.setblocking(False)
+            return self._sock.recv(1, socket.MSG_PEEK) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            if self._sock is not None:
+                self._sock.settimeout(self.timeout)
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._send(("AUTH", self.password))
+            self._read()
+        if self.db:
+            self._send(("SELECT", self.db))
+            self._read()
+
+    def _close(self):
+        for closable in (self._reader, self._sock):
+            try:
+                if closable is not None:
+                    closable.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    def _send(self, args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._sock.sendall(b"".join(parts))
+
+    def _read(self):
+        line = self._reader.readline()
+        if not line:
+            raise EOFError("connection closed")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode()
+        if prefix == b"-":
+            raise RespError(rest.decode())
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self._reader.read(n + 2)
+            return data[:-2]
+        if prefix == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise RespError(f"unexpected reply: {line!r}")
+
+class RedisStateBackend:
+    """Redis 互換サーバ（複数ホストのレプリカで共有）"""
+    def __init__(self, url: str, ttl_sec: float = DEFAULT_TTL_SEC, prefix: str = "careplan:session"):
+        self.client = RespClient(url)
+        self.ttl_sec = int(ttl_sec)
+        self.prefix = prefix
+
+    def get(self, session_id: str, key: str):
+        raw = self.client.execute("GET", self._key(session_id, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, session_id: str, key: str, value):
+        self.client.execute("SET", self._key(session_id, key), json.dumps(value, ensure_ascii=False), "EX", self.ttl_sec)
+
+    def append_history(self, session_id: str, type: str, ts: str, payload: dict):
+        key = self._key(session_id, "history")
+        self.client.execute("RPUSH", key, json.dumps({"type": type, "ts": ts, "payload": payload}, ensure_ascii=False))
+        self.client.execute("EXPIRE", key, self.ttl_sec)
+
+    def load_history(self, session_id: str) -> list:
+        items = self.client.execute("LRANGE", self._key(session_id, "history"), 0, -1) or []
+        return [(rec["type"], rec["ts"], rec["payload"]) for rec in map(json.loads, items)]
+
+    def discard(self, session_id: str):
+        self.client.execute(
+            "DEL", *(self._key(session_id, k) for k in ("last_outputs", "q_nonce", "history", "client"))
+        )
+
+    def _key(self, session_id: str, key: str) -> str:
+        return f"{self.prefix}:{session_id}:{key}"
+
+def build_state_backend_from_env():
+    """設定に応じたバックエンド（"session" なら None = st.session_state のみ）"""
+    kind = os.getenv("CAREPLAN_STATE_BACKEND", "session")
+    ttl_sec = float(os.getenv("CAREPLAN_STATE_TTL_SEC", DEFAULT_TTL_SEC))
+    if kind == "sqlite":
+        return SQLiteStateBackend(os.getenv("CAREPLAN_STATE_PATH") or DEFAULT_SQLITE_PATH, ttl_sec)
+    if kind == "redis":
+        return RedisStateBackend(os.getenv("CAREPLAN_REDIS_URL", "redis://127.0.0.1:6379/0"), ttl_sec)
+    return None
+
+_backend = None
+_backend_ready = False
+_backend_lock = threading.Lock()
+
+def get_state_backend():
+    """プロセス共有のバックエンド（初回呼び出し時に環境変数から構築）"""
+    global _backend, _backend_ready
+    with _backend_lock:
+        if not _backend_ready:
+            _backend = build_state_backend_from_env()
+            _backend_ready = True
+    return _backend
@@ -0,0 +1,176 @@
+"""
+concurrency.SingleFlight / FairLimiter のテスト（APIキー不要）。
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concurrency import SingleFlight, FairLimiter, QueueTimeout
+
+class _Aborted(BaseException):
+    """Streamlit の再実行による停止（StopException など BaseException 系）の代わり"""
+
+def _wait_until(cond, timeout: float = 2.0):
+    deadline = time.perf_counter() + timeout
+    while not cond():
+        if time.perf_counter() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+def _start(fn, *args):
+    t = threading.Thread(target=fn, args=args, daemon=True)
+    t.start()
+    return t
+
+# ===== SingleFlight =====
+def test_single_flight_shares_result_of_running_call():
+    sf = SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fn():
+        calls.append(1)
+        release.wait(2)
+        return {"plan": 1}
+
+    leader = _start(lambda: results.append(sf.do("k", fn)))
+    _wait_until(lambda: calls)
+    follower = _start(lambda: results.append(sf.do("k", fn)))
+    time.sleep(0.05)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True]
+    assert all(result == {"plan": 1} for result, _ in results)
+    assert sf.stats() == {"calls": 1, "shared": 1, "in_flight": 0}
+
+def test_single_flight_reraises_error_to_followers():
+    sf = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fn():
+        release.wait(2)
+        raise ValueError("boom")
+
+    def call():
+        try:
+            sf.do("k", fn)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = _start(call)
+    _wait_until(lambda: sf.stats()["in_flight"] == 1)
+    follower = _start(call)
+    time.sleep(0.05)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+def test_single_flight_follower_reruns_when_leader_is_aborted():
+    sf = SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def aborted():
+        calls.append("leader")
+        release.wait(2)
+        raise _Aborted()
+
+    def leader_call():
+        with pytest.raises(_Aborted):
+            sf.do("k", aborted)
+
+    def fn():
+        calls.append("follower")
+        return "ok"
+
+    leader = _start(leader_call)
+    _wait_until(lambda: calls)
+    follower = _start(lambda: results.append(sf.do("k", fn)))
+    time.sleep(0.05)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+    # 中断された結果は共有せず、待っていた側が自分で実行し直す
+    assert calls == ["leader", "follower"]
+    assert results == [("ok", False)]
+    assert sf.stats()["in_flight"] == 0
+
+def test_single_flight_runs_again_after_completion():
+    sf = SingleFlight()
+    assert sf.do("k", lambda: 1) == (1, False)
+    assert sf.do("k", lambda: 2) == (2, False)
+
+# ===== FairLimiter =====
+def _hold(limiter: FairLimiter, user: str, entered: list, release: threading.Event):
+    with limiter.slot(user):
+        entered.append(user)
+        release.wait(2)
+
+def test_fair_limiter_caps_slots_per_user():
+    limiter = FairLimiter(limit=4, per_user=2, timeout_sec=2)
+    release = threading.Event()
+    entered = []
+    threads = [_start(_hold, limiter, "a", entered, release) for _ in range(3)]
+    _wait_until(lambda: len(entered) == 2)
+    threads.append(_start(_hold, limiter, "b", entered, release))
+    _wait_until(lambda: len(entered) == 3)
+    # a の3件目は待たされ、b は先に実行できる
+    assert entered == ["a", "a", "b"]
+    assert limiter.stats()["waiting"] == 1
+    release.set()
+    for t in threads:
+        t.join(2)
+    stats = limiter.stats()
+    assert stats["active"] == 0 and stats["waiting"] == 0 and stats["acquired"] == 4
+
+def test_fair_limiter_rotates_between_waiting_users():
+    limiter = FairLimiter(limit=1, per_user=1, timeout_sec=2)
+    order = []
+    gate = threading.Event()
+
+    def run(user: str):
+        with limiter.slot(user):
+            order.append(user)
+            gate.wait(2)
+
+    holder = _start(run, "x")
+    _wait_until(lambda: order == ["x"])
+    threads = []
+    for user in ("a", "a", "b"):
+        threads.append(_start(run, user))
+        waiting = len(threads)
+        _wait_until(lambda: limiter.stats()["waiting"] == waiting)
+    gate.set()
+    for t in [holder, *threads]:
+        t.join(2)
+    # a が2件先に並んでいても、a の1件目の次は b に順番が回る
+    assert order == ["x", "a", "b", "a"]
+
+def test_fair_limiter_times_out_and_leaves_queue():
+    limiter = FairLimiter(limit=1, per_user=1, timeout_sec=0.05)
+    release = threading.Event()
+    entered = []
+    holder = _start(_hold, limiter, "a", entered, release)
+    _wait_until(lambda: entered)
+    with pytest.raises(QueueTimeout):
+        with limiter.slot("b"):
+            pass
+    stats = limiter.stats()
+    assert stats["timeouts"] == 1 and stats["waiting"] == 0
+    release.set()
+    holder.join(2)
+    with limiter.slot("b") as wait_ms:
+        assert wait_ms >= 0
@@ -1,34 +1,126 @@
+"""
+セッション状態・会話履歴と、生成結果の検証・差分などの共通処理。
+
+外部保存（CAREPLAN_STATE_BACKEND=sqlite / redis）を使うと、URL の ?sid= から同じセッションを復元できます。
+?sid= は共有・転送されうるため、復元は保存時と同じ接続元（User-Agent・言語・送信元 IP のハッシュ）からに限ります。
+同じ端末・同じブラウザを複数人で使う場合は区別できないため、使い終わったら「終了」で履歴を破棄してください。
+"""
+import os
 import re
 import json
+import uuid
+import difflib
+import hashlib
 from datetime import datetime, timezone
 import streamlit as st
+from prompts import PLAN_SECTIONS
+from history_store import HistoryStore
+from relevance import is_relevant
+from state_backend import get_state_backend
 
-RELEVANT_KEYWORDS = [
-    "看護", "患者", "診断", "目標", "介入", "評価", "アセスメント", "SOAP", "計画", "根拠", "要点",
-    "NANDA", "NANDA-I", "NIC", "NOC"
-]
+_SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
 
 def ensure_session_state():
+    backend = get_state_backend()   # CAREPLAN_STATE_BACKEND（既定は st.session_state のみ）
+    if "session_id" not in st.session_state:
+        sid = st.query_params.get("sid") if backend is not None else None
+        # URL は共有・転送されうるため、?sid= だけでは復元しない（保存時と同じ接続元のブラウザに限る）
+        restoring = (bool(sid) and bool(_SESSION_ID_RE.match(sid))
+                     and backend.get(sid, "client") == _client_fingerprint())
+        st.session_state["session_id"] = sid if restoring else uuid.uuid4().hex
+        if backend is not None:
+            # URL に残しておき、再読み込み・別レプリカへの振り分け後も同じセッションを復元する
+            st.query_params["sid"] = st.session_state["session_id"]
+            _bind_client(backend)
+            if restoring:
+                _restore_session(backend, sid)
     st.session_state.setdefault("last_outputs", None)   # 直近の結果（Q&Aのコンテキスト用）
-    st.session_state.setdefault("history", [])          # セッション内のみ保持する会話履歴（生成・Q&A）
+    if "history" not in st.session_state:               # セッション内のみ保持する会話履歴（生成・Q&A、上限超過分はディスクへ退避）
+        st.session_state["history"] = HistoryStore(st.session_state["session_id"])
     st.session_state.setdefault("followup_q", "")       # フォローアップ質問欄の入力内容（送信後にクリア）
+    st.session_state.setdefault("q_nonce", 0)           # フォローアップ入力欄のキー用ノンス（セッション内で増分）
+
+def _client_fingerprint() -> str:
+    """接続元ブラウザの識別値（User-Agent・言語・送信元 IP のハッシュ。URL には含まれない）"""
+    try:
+        headers = st.context.headers
+        forwarded = (headers.get("X-Forwarded-For") or "").split(",")[0].strip()
+        parts = [headers.get("User-Agent"), headers.get("Accept-Language"), forwarded or st.context.ip_address]
+    except Exception:
+        parts = []
+    text = "\n".join(p if isinstance(p, str) else "" for p in parts)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+def _bind_client(backend):
+    # 復元を許す接続元を記録する（保存期間の延長を兼ねて生成のたびに更新）
+    backend.set(st.session_state["session_id"], "client", _client_fingerprint())
+
+def _restore_session(backend, sid: str):
+    last = backend.get(sid, "last_outputs")
+    history = HistoryStore(sid)
+    history.pin(last)
+    for type, ts, payload in backend.load_history(sid):
+        # 直近の生成結果と同じ内容なら last_outputs の dict を共有する（二重保持しない）
+        history.append(type, ts, last if payload == last else payload)
+    st.session_state["last_outputs"] = last
+    st.session_state["history"] = history
+    st.session_state["q_nonce"] = backend.get(sid, "q_nonce") or 0
+
+def end_session():
+    """「終了」: 履歴（退避ファイルを含む）と外部保存した状態を破棄し、新しいセッションを始める"""
+    sid = st.session_state.get("session_id")
+    history = st.session_state.get("history")
+    if history is not None:
+        history.discard()
+    backend = get_state_backend()
+    if backend is not None and sid:
+        backend.discard(sid)
+        st.query_params.pop("sid", None)
+    for key in ("session_id", "last_outputs", "history", "q_nonce"):
+        st.session_state.pop(key, None)
+    ensure_session_state()
+
+def next_q_nonce():
+    """フォローアップ入力欄のキーを更新する（=テキストボックスが空に戻る）"""
+    st.session_state["q_nonce"] += 1
+    backend = get_state_backend()
+    if backend is not None:
+        backend.set(st.session_state["session_id"], "q_nonce", st.session_state["q_nonce"])
 
 def save_last_outputs(result, patient_text, output_format):
-    st.session_state["last_outputs"] = {
+    st.session_state["last_outputs"] = _generation_payload(patient_text, output_format, result)
+    st.session_state["history"].pin(st.session_state["last_outputs"])
+    backend = get_state_backend()
+    if backend is not None:
+        backend.set(st.session_state["session_id"], "last_outputs", st.session_state["last_outputs"])
+        _bind_client(backend)
+
+def _generation_payload(patient_text: str, output_format: str, result: dict) -> dict:
+    # 直前に save_last_outputs した同じ結果なら、その dict をそのまま共有する（二重保持しない）
+    last = st.session_state.get("last_outputs")
+    if (last is not None and last.get("patient_text") == patient_text and last.get("output_format") == output_format
+            and last.get("soap") is result.get("soap") and last.get("plan_table") is result.get("plan_table")):
+        return last
+    return {
         "patient_text": patient_text,
         "output_format": output_format,
         "soap": result.get("soap"),
         "plan_table": result.get("plan_table"),
-        "reasoning_summary": result.get("reasoning_summary")
+        "reasoning_summary": result.get("reasoning_summary"),
+        "incremental": result.get("incremental")
     }
 
+def is_admin() -> bool:
+    # CAREPLAN_ADMIN_TOKEN を設定し、URL に ?admin=<token> を付けたときのみ管理者表示
+    token = os.getenv("CAREPLAN_ADMIN_TOKEN")
+    return bool(token) and st.query_params.get("admin") == token
+
 def has_last_outputs():
     return st.session_state.get("last_outputs") is not None
 
-def is_relevant_question(q: str) -> bool:
-    q = q.strip()
-    if not q: return False
-    return any(k.lower() in q.lower() for k in RELEVANT_KEYWORDS)
+def is_relevant_question(q: str, last_outputs: dict = None) -> bool:
+    # キーワード（Aho–Corasick）＋直近の生成結果との語の重なり・類似度で判定（relevance.py）
+    return is_relevant(q, last_outputs)
 
 def json_loads_safe(s: str):
     try:
@@ -42,31 +134,148 @@ def json_loads_safe(s: str):
         except Exception:
             return None
 
+def validate_plan(data, required_sections=()):
+    """
+    解析済みの出力をセクション単位で型検証する。
+    返り値: (plan, failed)  plan は欠けたセクションを空リストで補完した dict、
+    failed は型不正または必須なのに空だったセクション名のリスト。
+    """
+    plan, failed = {}, []
+    data = data if isinstance(data, dict) else {}
+    for section, keys in PLAN_SECTIONS.items():
+        raw = data.get(section)
+        ok = isinstance(raw, dict)
+        clean = {}
+        for k in keys:
+            items = raw.get(k, []) if ok else []
+            if not isinstance(items, list) or not all(isinstance(x, (str, int, float)) for x in items):
+                ok = False
+                items = []
+            clean[k] = [str(x) for x in items]
+        if section in required_sections and (not ok or not any(clean.values())):
+            failed.append(section)
+        plan[section] = clean
+    return plan, failed
+
+_REF_RE = re.compile(r"^#(\d+)$")
+
+def expand_example_refs(plan, example_plan: dict):
+    """
+    参考例の項目参照（"#2" など）を参考例の同じキーの項目本文に置き換える。
+    参照先がない場合はその項目を落とす。plan は変更せず新しい dict を返す。
+    """
+    if not isinstance(plan, dict) or not example_plan:
+        return plan
+    out = {}
+    for section, fields in plan.items():
+        if not isinstance(fields, dict):
+            out[section] = fields
+            continue
+        out[section] = {}
+        for key, items in fields.items():
+            source = ((example_plan.get(section) or {}).get(key)) or []
+            if not isinstance(items, list):
+                out[section][key] = items
+                continue
+            expanded = []
+            for x in items:
+                m = _REF_RE.match(x.strip()) if isinstance(x, str) else None
+                if m is None:
+                    expanded.append(x)
+                elif 1 <= int(m.group(1)) <= len(source):
+                    expanded.append(source[int(m.group(1)) - 1])
+            out[section][key] = expanded
+    return out
+
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[。．])|\n")
+
+def split_sentences(text: str) -> list:
+    return [s.strip() for s in _SENTENCE_SPLIT_RE.split(text or "") if s and s.strip()]
+
+def diff_patient_text(old: str, new: str) -> dict:
+    """
+    前回と今回の看護情報の差分（difflib）。
+    {"added": 追加・変更後の文, "removed": 削除・変更前の文, "ratio": 文字単位の一致率}
+    """
+    a, b = split_sentences(old), split_sentences(new)
+    added, removed = [], []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(a=a, b=b, autojunk=False).get_opcodes():
+        if tag in ("replace", "delete"):
+            removed.extend(a[i1:i2])
+        if tag in ("replace", "insert"):
+            added.extend(b[j1:j2])
+    ratio = difflib.SequenceMatcher(a=old or "", b=new or "", autojunk=False).ratio()
+    return {"added": added, "removed": removed, "ratio": ratio}
+
+class PlanStreamParser:
+    """
+    ストリーミング中のJSON断片を逐次解析し、配列内の文字列要素が閉じた時点で返す。
+    feed() は (path, value) のリストを返す。path はキーのタプル（例: ("soap", "assessment")）。
+    """
+    def __init__(self):
+        self.stack = []          # {"type": "obj"|"arr", "key": str|None, "expect_key": bool}
+        self.in_string = False
+        self.escape = False
+        self.buf = []
+
+    def feed(self, text: str) -> list:
+        items = []
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self.buf.append(ch)
+                elif ch == "\\":
+                    self.escape = True
+                    self.buf.append(ch)
+                elif ch == '"':
+                    self.in_string = False
+                    item = self._close_string()
+                    if item: items.append(item)
+                else:
+                    self.buf.append(ch)
+            elif ch == '"':
+                self.in_string = True
+                self.buf = []
+            elif ch == "{":
+                self.stack.append({"type": "obj", "key": None, "expect_key": True})
+            elif ch == "[":
+                self.stack.append({"type": "arr"})
+            elif ch in "}]":
+                if self.stack: self.stack.pop()
+            elif ch == "," and self.stack and self.stack[-1]["type"] == "obj":
+                self.stack[-1]["expect_key"] = True
+        return items
+
+    def _close_string(self):
+        try:
+            value = json.loads('"' + "".join(self.buf) + '"')
+        except Exception:
+            value = "".join(self.buf)
+        if not self.stack:
+            return None
+        top = self.stack[-1]
+        if top["type"] == "obj":
+            if top["expect_key"]:
+                top["key"] = value
+                top["expect_key"] = False
+            return None
+        path = tuple(f["key"] for f in self.stack if f["type"] == "obj")
+        return path, value
+
 # ===== Session-scoped conversation history =====
 def append_history_generation(patient_text: str, output_format: str, result: dict):
-    entry = {
-        "type": "generation",
-        "ts": now_iso(),
-        "payload": {
-            "patient_text": patient_text,
-            "output_format": output_format,
-            "soap": result.get("soap"),
-            "plan_table": result.get("plan_table"),
-            "reasoning_summary": result.get("reasoning_summary"),
-        }
-    }
-    st.session_state["history"].append(entry)
+    _append_history("generation", _generation_payload(patient_text, output_format, result))
 
 def append_history_followup(question: str, answer: str):
-    entry = {
-        "type": "followup",
-        "ts": now_iso(),
-        "payload": {
-            "question": question,
-            "answer": answer
-        }
-    }
-    st.session_state["history"].append(entry)
+    _append_history("followup", {"question": question, "answer": answer})
+
+def _append_history(type: str, payload: dict):
+    ts = now_iso()
+    st.session_state["history"].append(type, ts, payload)
+    backend = get_state_backend()
+    if backend is not None:
+        backend.append_history(st.session_state["session_id"], type, ts, payload)
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).astimezone().isoformat(timespec="seconds")
@@ -0,0 +1,177 @@
+"""
+推論ワーカー（UI とは別プロセスでモデル呼び出しを担当）。
+
+    python worker.py --port 8900 --processes 4
+
+UI 側は INFERENCE_WORKER_URL=http://127.0.0.1:8900 を設定すると、生成・フォローアップをこのワーカーへ依頼します
+（UI のレプリカを増やしても、モデル呼び出し・応答キャッシュ・類似検索の索引はワーカー側にまとまる）。
+--processes 2 以上ではソケットを開いてから fork し、各プロセスが同じポートで受け付けます（Linux / macOS）。
+プロセス間でキャッシュ・索引を共有するには CAREPLAN_CACHE_PATH / CAREPLAN_RETRIEVAL_PATH を指定してください。
+
+  POST /v1/generate  {"patient_text", "output_format", "use_retrieval", "user", "previous", "stream"}
+  POST /v1/followup  {"last_outputs", "question", "user", "stream"}
+  GET  /v1/stats     統計（応答したプロセス分）
+  GET  /healthz
+応答は NDJSON（途中結果の行のあとに {"result": ...}）。
+"""
+import os
+import sys
+import json
+import signal
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dotenv import load_dotenv
+
+load_dotenv(override=False)   # 各モジュールが import 時に環境変数を読むため最初に読み込む
+
+import inference
+import metrics
+from concurrency import concurrency_stats
+from initialize import build_openai_client, get_pool_stats
+
+logger = logging.getLogger("careplan.worker")
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    # fork 後の各プロセスで最初のリクエスト時に作る（接続プールをプロセス間で共有しない）
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = build_openai_client()
+    return _client
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self._json({"ok": True, "pid": os.getpid()})
+        elif self.path == "/v1/stats":
+            self._json({
+                "pid": os.getpid(),
+                "cache": inference.cache_stats(),
+                "usage": inference.usage_stats(),
+                "parse": inference.parse_stats(),
+                "concurrency": concurrency_stats(),
+                "pool": get_pool_stats(),
+                "metrics": metrics.summary(),
+                "models": metrics.summary(by="model"),
+            })
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError:
+            self.send_error(400, "invalid json")
+            return
+        if self.path == "/v1/generate":
+            self._start_stream()
+            stream = bool(body.get("stream"))
+            result = inference.generate_care_plan(
+                get_client(), body.get("patient_text") or "", body.get("output_format") or "両方",
+                on_partial=(lambda partial: self._send({"partial": partial})) if stream else None,
+                use_retrieval=body.get("use_retrieval", True), user=body.get("user"), previous=body.get("previous")
+            )
+            self._send({"result": result})
+        elif self.path == "/v1/followup":
+            self._start_stream()
+            stream = bool(body.get("stream"))
+            result = inference.answer_followup(
+                get_client(), body.get("last_outputs") or {}, body.get("question") or "",
+                on_delta=(lambda delta: self._send({"delta": delta})) if stream else None,
+                user=body.get("user")
+            )
+            self._send({"result": result})
+        else:
+            self.send_error(404)
+        self.close_connection = True
+
+    def _start_stream(self):
+        self.disconnected = False
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    def _send(self, data: dict):
+        # クライアントが切断していても例外にしない（同じ入力を待つ他のリクエストと生成を共有しているため、
+        # ここで打ち切ると相乗りした側にも BrokenPipeError が返る）。以降の書き込みだけをやめる
+        if self.disconnected:
+            return
+        try:
+            self.wfile.write(json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+        except OSError:
+            self.disconnected = True
+            logger.info("client disconnected: %s", self.path)
+
+    def _json(self, data: dict):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def start_server(host: str = "127.0.0.1", port: int = 0):
+    """バックグラウンドスレッドで1プロセス分を起動し、(server, base_url) を返す（検証用）"""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def serve(host: str, port: int, processes: int):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"inference worker: http://{host}:{server.server_address[1]} ({processes} process(es))", flush=True)
+    if processes <= 1:
+        server.serve_forever()
+        return
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        # 親が止められたら子プロセスも止める（孤児として残さない）
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="推論ワーカー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--processes", type=int, default=int(os.getenv("INFERENCE_WORKER_PROCESSES", "1")))
+    args = parser.parse_args()
+    if not os.getenv("OPENAI_API_KEY"):
+        sys.exit("OPENAI_API_KEY が設定されていません。")
+    if args.processes > 1 and not hasattr(os, "fork"):
+        sys.exit("--processes 2 以上は fork が使える環境でのみ利用できます。")
+    serve(args.host, args.port, args.processes)
+
+if __name__ == "__main__":
+    main()
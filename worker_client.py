@@ -0,0 +1,96 @@
+"""
+推論ワーカー（worker.py）のクライアント。INFERENCE_WORKER_URL を設定すると UI はモデルを直接呼ばず、
+このモジュールの generate_care_plan / answer_followup（inference と同じ引数）でワーカーへ依頼します。
+
+ワーカーは改行区切りJSON（NDJSON）で途中結果を返し、最後の行に結果を返します:
+  {"partial": {...}} / {"delta": "..."} ... {"result": {...}}
+"""
+import os
+import json
+import logging
+from metrics import request_span
+
+READ_TIMEOUT_SEC = float(os.getenv("INFERENCE_WORKER_TIMEOUT_SEC", "180"))
+
+logger = logging.getLogger(__name__)
+
+def worker_url() -> str:
+    return os.getenv("INFERENCE_WORKER_URL")
+
+class WorkerClient:
+    def __init__(self, base_url: str, timeout_sec: float = READ_TIMEOUT_SEC):
+        import httpx
+        self.base_url = base_url.rstrip("/")
+        self._http = httpx.Client(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(timeout_sec, connect=5.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+        )
+
+    def stream(self, path: str, body: dict):
+        """POST して NDJSON の各行を dict で返す"""
+        with self._http.stream("POST", path, json=body) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    def get(self, path: str) -> dict:
+        resp = self._http.get(path)
+        resp.raise_for_status()
+        return resp.json()
+
+def _result(span, result: dict) -> dict:
+    # ワーカー側で失敗した結果もこちらの計測ではエラーとして数える
+    if isinstance(result, dict) and "error" in result:
+        span.set("status", "error")
+    return result
+
+def generate_care_plan(client: WorkerClient, patient_text: str, output_format: str, on_partial=None, use_retrieval=True,
+                       user: str = None, previous: dict = None):
+    body = {
+        "patient_text": patient_text, "output_format": output_format, "use_retrieval": use_retrieval,
+        "user": user, "previous": previous, "stream": on_partial is not None,
+    }
+    with request_span("worker_generation") as span:
+        try:
+            span.mark_sent()   # ワーカーへの依頼1回（queue_ms はワーカー到達まで）
+            for msg in client.stream("/v1/generate", body):
+                if "result" in msg:
+                    return _result(span, msg["result"])
+                span.mark_first_token()
+                if on_partial is not None:
+                    on_partial(msg["partial"])
+            span.set("status", "error")
+            return {"error": "推論ワーカーの応答が途中で終了しました。再度実行してください。"}
+        except Exception as e:
+            logger.exception("worker generate_care_plan failed")
+            span.set("status", "error")
+            span.set("error_type", type(e).__name__)
+            return {"error": f"推論ワーカーへの依頼に失敗しました: {e}"}
+
+def answer_followup(client: WorkerClient, last_outputs: dict, question: str, on_delta=None, user: str = None):
+    body = {"last_outputs": last_outputs, "question": question, "user": user, "stream": on_delta is not None}
+    with request_span("worker_followup") as span:
+        try:
+            span.mark_sent()   # ワーカーへの依頼1回（queue_ms はワーカー到達まで）
+            for msg in client.stream("/v1/followup", body):
+                if "result" in msg:
+                    return _result(span, msg["result"])
+                span.mark_first_token()
+                if on_delta is not None:
+                    on_delta(msg["delta"])
+            span.set("status", "error")
+            return {"error": "推論ワーカーの応答が途中で終了しました。再度実行してください。"}
+        except Exception as e:
+            logger.exception("worker answer_followup failed")
+            span.set("status", "error")
+            span.set("error_type", type(e).__name__)
+            return {"error": f"推論ワーカーへの依頼に失敗しました: {e}"}
+
+def worker_stats(client: WorkerClient) -> dict:
+    """応答したワーカープロセスの統計（キャッシュ・usage・同時実行制御・計測）"""
+    try:
+        return client.get("/v1/stats")
+    except Exception as e:
+        return {"error": str(e)}